@@ -0,0 +1,51 @@
+import os
+import multiprocessing
+
+def _memory_limit_mb():
+    """
+    Memory available to the dyno/container in MB, or None if unknown
+    """
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 50:
+            return int(value) // (1024 * 1024)
+    return None
+
+def _worker_count():
+    """
+    Derive the worker count from CPU cores and the memory budget per worker
+    """
+    if os.getenv('WEB_CONCURRENCY'):
+        return int(os.getenv('WEB_CONCURRENCY'))
+
+    workers = multiprocessing.cpu_count() * 2 + 1
+    memory_mb = _memory_limit_mb()
+    if memory_mb:
+        per_worker_mb = int(os.getenv('WORKER_MEMORY_MB', '256'))
+        workers = min(workers, memory_mb // per_worker_mb)
+    return max(workers, 1)
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = 'uvicorn.workers.UvicornWorker'
+workers = _worker_count()
+# Read by the preloaded app to split the OpenAI rate limits across processes
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# Import the app once in the master so forked workers share its memory
+preload_app = True
+
+# Recycle workers periodically, staggered so they do not restart together
+max_requests = int(os.getenv('MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', '100'))
+
+# Give in-flight analyses time to finish on restart/shutdown
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '60'))
+timeout = int(os.getenv('WORKER_TIMEOUT', '120'))
+keepalive = 5
+
+loglevel = os.getenv('LOG_LEVEL', 'info')
+accesslog = '-'
@@ -1,11 +1,27 @@
 import os
+import json
+import time
+import asyncio
+import hashlib
 import logging
+import sqlite3
+import threading
+import glob
+import re
+import random
+import httpx
+import uuid
+import tiktoken
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
-from openai import OpenAI
-from supabase import create_client, Client
+from contextvars import ContextVar
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from supabase import acreate_client, AsyncClient
+from postgrest.exceptions import APIError
 from dotenv import load_dotenv
-from typing import Dict
-from fastapi import FastAPI, HTTPException
+from typing import Dict, List, Literal, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 # Set up logging
@@ -24,76 +40,1722 @@ async def lifespan(app: FastAPI):
         logger.error("Missing required environment variables!")
     else:
         logger.info("All required environment variables are set")
+
+    # Initialize async Supabase client (needs a running event loop)
+    global supabase
+    supabase = await acreate_client(
+        os.getenv('SUPABASE_URL'),
+        os.getenv('SUPABASE_KEY')
+    )
+
+    # Load the tokenizers up front; the first load downloads the encoding file
+    for model in {ANALYSIS_MODEL, *model_router.tier_models.values()}:
+        try:
+            await asyncio.to_thread(load_encoding, model)
+        except Exception as e:
+            logger.error(f"Could not load tokenizer for {model}, estimating tokens until it loads: {str(e)}")
+
+    if write_behind is not None:
+        await write_behind.start()
     yield
     # Shutdown
     logger.info("Shutting down application...")
+    if write_behind is not None:
+        await write_behind.stop()
+    await client.close()
 
 # Initialize FastAPI with lifespan
 app = FastAPI(lifespan=lifespan)
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# Initialize OpenAI client; retries are handled by with_retries under the retry budget
+client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+# Supabase client is created in lifespan, since the async client is awaited
+supabase: Optional[AsyncClient] = None
+
+class StageLimiter:
+    """
+    Bounded concurrency for one pipeline stage, tracking queue depth and wait time
+    """
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # Created lazily so the semaphore binds to the server's event loop
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+
+        start = time.monotonic()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        wait = time.monotonic() - start
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict:
+        started = self.completed + self.in_flight
+        return {
+            'size': self.size,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'completed': self.completed,
+            'avg_wait_seconds': round(self.total_wait / started, 4) if started else 0.0,
+            'max_wait_seconds': round(self.max_wait, 4)
+        }
+
+# Separate limits per stage so slow completions cannot starve the Supabase reads and writes
+stage_limits = {
+    'fetch': StageLimiter('fetch', int(os.getenv('FETCH_CONCURRENCY', '50'))),
+    'analyze': StageLimiter('analyze', int(os.getenv('ANALYZE_CONCURRENCY', '16'))),
+    'update': StageLimiter('update', int(os.getenv('UPDATE_CONCURRENCY', '50')))
+}
+
+class LLMCache:
+    """
+    SQLite-backed cache of completions keyed on a hash of the full request
+    """
+    def __init__(self, path: str, ttl_seconds: int, max_bytes: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, system_message: str, prompt: str, schema: Dict) -> str:
+        payload = json.dumps([model, system_message, prompt, schema], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS llm_cache ('
+                    'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                    'created_at REAL NOT NULL, last_access REAL NOT NULL)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)')
+                conn.commit()
+                self._initialized = True
+        return conn
+
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                'SELECT value, created_at FROM llm_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl_seconds:
+                conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                conn.commit()
+                return None
+            conn.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (now, key))
+            conn.commit()
+            return row[0]
+        finally:
+            conn.close()
+
+    def _set(self, key: str, value: str):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, last_access) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, value, len(value.encode('utf-8')), now, now)
+            )
+            # Drop expired entries, then least recently used ones until under the size cap
+            evicted = conn.execute(
+                'DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl_seconds,)
+            ).rowcount
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+            if total > self.max_bytes:
+                for old_key, size in conn.execute(
+                    'SELECT key, size FROM llm_cache ORDER BY last_access'
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute('DELETE FROM llm_cache WHERE key = ?', (old_key,))
+                    total -= size
+                    evicted += 1
+            conn.commit()
+            self.evictions += evicted
+        finally:
+            conn.close()
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            value = await asyncio.to_thread(self._get, key)
+        except sqlite3.Error as e:
+            logger.warning(f"LLM cache read failed: {str(e)}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: str):
+        try:
+            await asyncio.to_thread(self._set, key, value)
+        except sqlite3.Error as e:
+            logger.warning(f"LLM cache write failed: {str(e)}")
+
+    def stats(self) -> Dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+# Persistent completion cache; set LLM_CACHE_PATH to an empty string to disable
+llm_cache: Optional[LLMCache] = None
+if os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'):
+    llm_cache = LLMCache(
+        os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'),
+        int(os.getenv('LLM_CACHE_TTL_SECONDS', str(7 * 24 * 3600))),
+        int(os.getenv('LLM_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+    )
+
+class SummaryCache:
+    """
+    In-memory TTL cache of competitor_summary rows, evicting least recently used rows
+    once their serialized size exceeds max_bytes
+    """
+    def __init__(self, ttl_seconds: float, max_bytes: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.rows: OrderedDict = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    def get(self, brand_name: str) -> Optional[Dict]:
+        entry = self.rows.get(brand_name)
+        if entry is None or entry['expires_at'] <= time.monotonic():
+            if entry is not None:
+                self._remove(brand_name)
+            self.misses += 1
+            return None
+        self.rows.move_to_end(brand_name)
+        self.hits += 1
+        return dict(entry['row'])
+
+    def set(self, brand_name: str, row: Dict, generation: int):
+        # Skip rows read before an invalidation, which may predate the write
+        if generation != self.generation:
+            return
+        size = len(json.dumps(row, default=str).encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        self._remove(brand_name)
+        self.rows[brand_name] = {'row': dict(row), 'size': size, 'expires_at': time.monotonic() + self.ttl_seconds}
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self.rows))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, brand_name: str):
+        self.generation += 1
+        if self._remove(brand_name):
+            self.invalidations += 1
+
+    def _remove(self, brand_name: str) -> bool:
+        entry = self.rows.pop(brand_name, None)
+        if entry is None:
+            return False
+        self.bytes -= entry['size']
+        return True
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            'rows': len(self.rows),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+# Per-process, so other workers may serve a row up to the TTL old; set SUMMARY_CACHE_TTL_SECONDS=0 to disable
+summary_cache: Optional[SummaryCache] = None
+if float(os.getenv('SUMMARY_CACHE_TTL_SECONDS', '60')) > 0:
+    summary_cache = SummaryCache(
+        float(os.getenv('SUMMARY_CACHE_TTL_SECONDS', '60')),
+        int(os.getenv('SUMMARY_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+    )
+
+class TokenBucketLimiter:
+    """
+    Client-side requests-per-minute and tokens-per-minute budgets for OpenAI calls.
+    Callers wait in order for budget instead of failing; a limit of 0 disables that bucket
+    """
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_budget = float(rpm)
+        self.token_budget = float(tpm)
+        self.waits = 0
+        self.total_wait = 0.0
+        self._updated = time.monotonic()
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self.request_budget = min(self.rpm, self.request_budget + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.token_budget = min(self.tpm, self.token_budget + elapsed * self.tpm / 60)
+
+    def _delay(self, tokens: int) -> float:
+        delay = 0.0
+        if self.rpm and self.request_budget < 1:
+            delay = max(delay, (1 - self.request_budget) * 60 / self.rpm)
+        if self.tpm and self.token_budget < tokens:
+            delay = max(delay, (tokens - self.token_budget) * 60 / self.tpm)
+        return delay
+
+    async def acquire(self, tokens: int):
+        if not self.rpm and not self.tpm:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # A call larger than the whole bucket could never run, so cap it at the bucket size
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+
+        # The lock keeps waiting callers in arrival order
+        async with self._lock:
+            start = time.monotonic()
+            self._refill()
+            delay = self._delay(tokens)
+            while delay > 0:
+                # Re-check periodically, since settled calls can refund tokens meanwhile
+                await asyncio.sleep(min(delay, 1.0))
+                self._refill()
+                delay = self._delay(tokens)
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self.waits += 1
+                self.total_wait += waited
+            if self.rpm:
+                self.request_budget -= 1
+            if self.tpm:
+                self.token_budget -= tokens
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """
+        Correct the token bucket once the real usage of a call is known
+        """
+        if self.tpm:
+            self._refill()
+            self.token_budget = min(self.tpm, self.token_budget + estimated_tokens - actual_tokens)
+
+    def stats(self) -> Dict:
+        self._refill()
+        return {
+            'rpm_limit': self.rpm,
+            'tpm_limit': self.tpm,
+            'requests_available': round(self.request_budget, 2) if self.rpm else None,
+            'tokens_available': round(self.token_budget) if self.tpm else None,
+            'waits': self.waits,
+            'total_wait_seconds': round(self.total_wait, 4)
+        }
+
+def rate_limit_processes() -> int:
+    """
+    Processes sharing the account's OpenAI limits: the gunicorn workers of a web dyno
+    (WEB_CONCURRENCY, which gunicorn.conf.py sets) times WEB_DYNOS, plus WORKER_DYNOS
+    job workers. OPENAI_RATE_LIMIT_PROCESSES overrides the count
+    """
+    if os.getenv('OPENAI_RATE_LIMIT_PROCESSES'):
+        return max(int(os.getenv('OPENAI_RATE_LIMIT_PROCESSES')), 1)
+    web_processes = int(os.getenv('WEB_CONCURRENCY', '1')) * int(os.getenv('WEB_DYNOS', '1'))
+    return max(web_processes + int(os.getenv('WORKER_DYNOS', '1')), 1)
+
+# Set these to the account's OpenAI limits (0 leaves that budget unenforced). Each bucket
+# is per process, so every process enforces an even share of them
+def process_share(limit: int) -> int:
+    # Keep a configured limit enforced even when the share rounds down to nothing
+    return max(limit // rate_limit_processes(), 1) if limit else 0
+
+openai_rate_limiter = TokenBucketLimiter(
+    process_share(int(os.getenv('OPENAI_RPM_LIMIT', '0'))),
+    process_share(int(os.getenv('OPENAI_TPM_LIMIT', '0')))
+)
+
+def percentile(values, fraction: float) -> float:
+    """
+    Nearest-rank percentile of a sequence of numbers
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on in-flight OpenAI calls: grows additively while calls are healthy and
+    is cut multiplicatively on 429s, timeouts or a p95 latency above target
+    """
+    def __init__(self, initial: int, min_limit: int, max_limit: int, latency_target: float,
+                 backoff: float = 0.5, cooldown: float = 5.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self.latencies = deque(maxlen=100)
+        self._last_decrease = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    @asynccontextmanager
+    async def slot(self, record_latency: bool = True):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        except (RateLimitError, APITimeoutError, asyncio.TimeoutError):
+            self._decrease()
+            raise
+        except asyncio.CancelledError:
+            # A cancelled call, such as a hedging loser, took at least this long
+            if record_latency:
+                self._observe(time.monotonic() - start, completed=False)
+            raise
+        else:
+            if record_latency:
+                self._observe(time.monotonic() - start, completed=True)
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def _observe(self, seconds: float, completed: bool):
+        self.latencies.append(seconds)
+        if len(self.latencies) >= 10 and percentile(self.latencies, 0.95) > self.latency_target:
+            self._decrease()
+        elif completed:
+            self._increase()
 
-# Initialize Supabase client
-supabase: Client = create_client(
-    os.getenv('SUPABASE_URL'),
-    os.getenv('SUPABASE_KEY')
+    def _increase(self):
+        if self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.increases += 1
+
+    def _decrease(self):
+        # One congestion event usually fails several calls at once; back off once for it
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        self.decreases += 1
+        logger.warning(f"Reduced OpenAI concurrency limit to {self.limit:.2f}")
+
+    def stats(self) -> Dict:
+        return {
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'p95_latency_seconds': round(percentile(self.latencies, 0.95), 4),
+            'increases': self.increases,
+            'decreases': self.decreases
+        }
+
+openai_concurrency = AdaptiveConcurrencyLimiter(
+    int(os.getenv('OPENAI_INITIAL_CONCURRENCY', '4')),
+    int(os.getenv('OPENAI_MIN_CONCURRENCY', '1')),
+    int(os.getenv('ANALYZE_CONCURRENCY', '16')),
+    float(os.getenv('OPENAI_LATENCY_TARGET_SECONDS', '60'))
+)
+
+def parse_reset_duration(value: Optional[str]) -> float:
+    """
+    Parse an OpenAI reset duration such as "20ms", "1s" or "6m0s" into seconds
+    """
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(amount) * units[unit] for amount, unit in re.findall(r'([\d.]+)(ms|s|m|h)', value or ''))
+
+class RateLimitHeaderScheduler:
+    """
+    Track the x-ratelimit-* headers OpenAI returns for each model and hold back new
+    calls when the remaining requests or tokens would run out before the reset
+    """
+    def __init__(self, reserve_requests: int, reserve_tokens: int):
+        self.reserve_requests = reserve_requests
+        self.reserve_tokens = reserve_tokens
+        self.models: Dict[str, Dict] = {}
+        self.delays = 0
+        self.total_delay = 0.0
+
+    def observe(self, model: str, headers):
+        if headers is None or 'x-ratelimit-remaining-requests' not in headers:
+            return
+        now = time.time()
+        self.models[model] = {
+            'limit_requests': int(headers.get('x-ratelimit-limit-requests', 0)),
+            'remaining_requests': int(headers.get('x-ratelimit-remaining-requests', 0)),
+            'reset_requests_at': now + parse_reset_duration(headers.get('x-ratelimit-reset-requests')),
+            'limit_tokens': int(headers.get('x-ratelimit-limit-tokens', 0)),
+            'remaining_tokens': int(headers.get('x-ratelimit-remaining-tokens', 0)),
+            'reset_tokens_at': now + parse_reset_duration(headers.get('x-ratelimit-reset-tokens')),
+            'observed_at': now
+        }
+
+    def delay_for(self, model: str, tokens: int) -> float:
+        state = self.models.get(model)
+        if state is None:
+            return 0.0
+        now = time.time()
+        delay = 0.0
+        if state['remaining_requests'] <= self.reserve_requests and state['reset_requests_at'] > now:
+            delay = max(delay, state['reset_requests_at'] - now)
+        if state['remaining_tokens'] - tokens < self.reserve_tokens and state['reset_tokens_at'] > now:
+            delay = max(delay, state['reset_tokens_at'] - now)
+        return delay
+
+    async def wait(self, model: str, tokens: int):
+        delay = self.delay_for(model, tokens)
+        if delay > 0:
+            self.delays += 1
+            self.total_delay += delay
+            logger.info(f"Delaying {model} call {delay:.2f}s for OpenAI rate limit reset")
+            await asyncio.sleep(delay)
+
+        # Count this call against the last-seen headroom until fresh headers arrive
+        state = self.models.get(model)
+        if state is not None:
+            state['remaining_requests'] -= 1
+            state['remaining_tokens'] -= tokens
+
+    def stats(self) -> Dict:
+        return {
+            'delays': self.delays,
+            'total_delay_seconds': round(self.total_delay, 4),
+            'models': self.models
+        }
+
+openai_headroom = RateLimitHeaderScheduler(
+    int(os.getenv('OPENAI_RESERVE_REQUESTS', '1')),
+    int(os.getenv('OPENAI_RESERVE_TOKENS', '0'))
+)
+
+class RetryPolicy:
+    """
+    Attempts and exponential backoff bounds for one pipeline stage
+    """
+    def __init__(self, attempts: int, base_delay: float, max_delay: float):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        # Full jitter spreads retries from many callers instead of syncing them up
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+class RetryBudget:
+    """
+    Process-wide cap on retries: each first attempt earns a fraction of a retry, plus a
+    small steady allowance, so retries cannot multiply traffic during an outage
+    """
+    def __init__(self, ratio: float, min_per_second: float, capacity: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.balance = capacity
+        self.exhausted = 0
+        self.retries: Dict[str, int] = {}
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.balance = min(self.capacity, self.balance + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def record_attempt(self):
+        self._refill()
+        self.balance = min(self.capacity, self.balance + self.ratio)
+
+    def try_spend(self, stage: str) -> bool:
+        self._refill()
+        if self.balance < 1:
+            self.exhausted += 1
+            return False
+        self.balance -= 1
+        self.retries[stage] = self.retries.get(stage, 0) + 1
+        return True
+
+    def stats(self) -> Dict:
+        self._refill()
+        return {
+            'balance': round(self.balance, 2),
+            'retries': self.retries,
+            'exhausted': self.exhausted
+        }
+
+retry_policies = {
+    'fetch': RetryPolicy(int(os.getenv('FETCH_RETRY_ATTEMPTS', '3')), 0.2, 2.0),
+    'analyze': RetryPolicy(int(os.getenv('ANALYZE_RETRY_ATTEMPTS', '3')), 2.0, 30.0),
+    'update': RetryPolicy(int(os.getenv('UPDATE_RETRY_ATTEMPTS', '5')), 0.2, 5.0)
+}
+
+retry_budget = RetryBudget(
+    float(os.getenv('RETRY_BUDGET_RATIO', '0.1')),
+    float(os.getenv('RETRY_BUDGET_MIN_PER_SECOND', '0.5')),
+    float(os.getenv('RETRY_BUDGET_CAPACITY', '20'))
+)
+
+# PostgREST connection and pool errors, and Postgres SQLSTATE classes that clear on retry:
+# connection exceptions, insufficient resources, operator intervention (e.g. statement
+# timeout, shutdown), serialization failures and deadlocks
+TRANSIENT_POSTGREST_CODES = ('PGRST000', 'PGRST001', 'PGRST002', 'PGRST003')
+TRANSIENT_SQLSTATE_PREFIXES = ('08', '53', '57', '40001', '40P01')
+
+def is_transient_postgrest_error(error: APIError) -> bool:
+    """
+    Whether a PostgREST error is transient. Without a JSON body (e.g. a gateway error
+    page) the code is the HTTP status
+    """
+    code = str(error.code or '')
+    if len(code) == 3 and code.isdigit():
+        return code == '429' or code.startswith('5')
+    return code in TRANSIENT_POSTGREST_CODES or code.startswith(TRANSIENT_SQLSTATE_PREFIXES)
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    Whether an error is worth retrying (connection problems, timeouts, 429s and 5xx)
+    """
+    if isinstance(error, APIError):
+        return is_transient_postgrest_error(error)
+    return isinstance(error, (
+        APIConnectionError, RateLimitError, InternalServerError,
+        httpx.TransportError, asyncio.TimeoutError, ConnectionError
+    ))
+
+async def with_retries(stage: str, operation):
+    """
+    Run one pipeline stage, retrying transient failures with jittered backoff while
+    the retry budget allows
+    """
+    policy = retry_policies[stage]
+    retry_budget.record_attempt()
+    attempt = 1
+    while True:
+        try:
+            return await operation()
+        except Exception as e:
+            if (attempt >= policy.attempts or not is_transient_error(e)
+                    or not retry_budget.try_spend(stage)):
+                raise
+            delay = policy.delay(attempt)
+            logger.warning(f"Retrying {stage} in {delay:.2f}s after attempt {attempt} failed: {str(e)}")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a stage cannot finish within the caller's latency budget
+    """
+
+class RequestDeadline:
+    """
+    Caller latency budget split across the pipeline stages. Each stage may use the time
+    left minus what is reserved for the stages after it, so time a stage does not use
+    rolls over to the next
+    """
+    stages = ('fetch', 'analyze', 'update')
+
+    def __init__(self, budget: float, shares: Dict[str, float]):
+        self.budget = budget
+        self.shares = shares
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def stage_timeout(self, stage: str) -> float:
+        later = self.stages[self.stages.index(stage) + 1:]
+        return self.remaining() - self.budget * sum(self.shares[name] for name in later)
+
+deadline_shares = {
+    'fetch': float(os.getenv('DEADLINE_FETCH_SHARE', '0.1')),
+    'update': float(os.getenv('DEADLINE_UPDATE_SHARE', '0.1'))
+}
+deadline_shares['analyze'] = max(0.0, 1 - deadline_shares['fetch'] - deadline_shares['update'])
+# Below this, an analysis is not started because the completion could not finish in time
+min_analyze_seconds = float(os.getenv('DEADLINE_MIN_ANALYZE_SECONDS', '5'))
+
+class SharedDeadline:
+    """
+    Deadline of a run shared by several callers: the latest of their deadlines, or none
+    while one of them has none. A run every caller has left keeps the last caller's
+    deadline, so it does not go on unbounded
+    """
+    def __init__(self):
+        self.waiters: List[Optional[RequestDeadline]] = []
+
+    def join(self, deadline: Optional[RequestDeadline]):
+        self.waiters.append(deadline)
+
+    def leave(self, deadline: Optional[RequestDeadline]):
+        if len(self.waiters) > 1:
+            self.waiters.remove(deadline)
+
+    def latest(self) -> Optional[RequestDeadline]:
+        if not self.waiters or None in self.waiters:
+            return None
+        return max(self.waiters, key=lambda deadline: deadline.expires_at)
+
+# Set per request from X-Request-Deadline; tasks started by the request inherit it
+request_deadline: ContextVar[Optional[RequestDeadline]] = ContextVar('request_deadline', default=None)
+# Set inside a coalesced run instead, since its callers can come and go while it runs
+shared_deadline: ContextVar[Optional[SharedDeadline]] = ContextVar('shared_deadline', default=None)
+deadlines_exceeded: Dict[str, int] = {}
+
+def current_deadline() -> Optional[RequestDeadline]:
+    shared = shared_deadline.get()
+    return shared.latest() if shared is not None else request_deadline.get()
+
+def parse_request_deadline(value: Optional[str]) -> Optional[RequestDeadline]:
+    """
+    Parse an X-Request-Deadline header: the caller's latency budget in milliseconds
+    """
+    if value is None:
+        return None
+    try:
+        budget_ms = int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-Request-Deadline must be a whole number of milliseconds")
+    if budget_ms <= 0:
+        raise HTTPException(status_code=400, detail="X-Request-Deadline must be positive")
+    return RequestDeadline(budget_ms / 1000, deadline_shares)
+
+def deadline_exceeded(stage: str, message: str) -> DeadlineExceeded:
+    deadlines_exceeded[stage] = deadlines_exceeded.get(stage, 0) + 1
+    logger.warning(message)
+    return DeadlineExceeded(message)
+
+async def run_stage(stage: str, operation):
+    """
+    Run a pipeline stage with retries, bounded by its share of the request deadline if one is set
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return await with_retries(stage, operation)
+
+    timeout = deadline.stage_timeout(stage)
+    if timeout <= 0 or (stage == 'analyze' and timeout < min_analyze_seconds):
+        raise deadline_exceeded(stage, f"Not enough of the request deadline left to {stage} ({max(timeout, 0):.2f}s)")
+
+    # A caller with a later deadline can join a shared run mid-stage, so the timeout is
+    # checked again when it runs out rather than fixed when the stage starts
+    task = asyncio.ensure_future(with_retries(stage, operation))
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+            if done:
+                return task.result()
+            deadline = current_deadline()
+            timeout = deadline.stage_timeout(stage) if deadline is not None else None
+            if timeout is not None and timeout <= 0:
+                raise deadline_exceeded(stage, f"{stage} did not finish within the request deadline")
+    finally:
+        task.cancel()
+
+async def within_deadline(awaitable):
+    """
+    Await a result for at most the time left on the request deadline. Callers that
+    joined a shared run are bounded by their own deadline, not the run's
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(deadline.remaining(), 0))
+    except asyncio.TimeoutError:
+        raise deadline_exceeded('request', "Request deadline passed before the analysis finished")
+
+class TokenUsageTracker:
+    """
+    Per-brand token counts for model calls, bounded to the most recently seen brands
+    """
+    def __init__(self, max_brands: int):
+        self.max_brands = max_brands
+        self.brands: OrderedDict = OrderedDict()
+        self.requests = 0
+        self.truncated_requests = 0
+        self.input_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, brand_name: str, input_tokens: int, truncated: bool, completion_tokens: int = 0):
+        self.requests += 1
+        self.truncated_requests += int(truncated)
+        self.input_tokens += input_tokens
+        self.completion_tokens += completion_tokens
+
+        usage = self.brands.pop(brand_name, None) or {
+            'requests': 0, 'truncated_requests': 0, 'input_tokens': 0, 'completion_tokens': 0
+        }
+        usage['requests'] += 1
+        usage['truncated_requests'] += int(truncated)
+        usage['input_tokens'] += input_tokens
+        usage['completion_tokens'] += completion_tokens
+        usage['last_input_tokens'] = input_tokens
+        self.brands[brand_name] = usage
+        while len(self.brands) > self.max_brands:
+            self.brands.popitem(last=False)
+
+        logger.info(f"Token usage for {brand_name}: {input_tokens} input, {completion_tokens} completion"
+                    + (" (input truncated)" if truncated else ""))
+
+    def stats(self) -> Dict:
+        top_brands = sorted(
+            self.brands.items(),
+            key=lambda item: item[1]['input_tokens'] + item[1]['completion_tokens'],
+            reverse=True
+        )[:20]
+        return {
+            'requests': self.requests,
+            'truncated_requests': self.truncated_requests,
+            'input_tokens': self.input_tokens,
+            'completion_tokens': self.completion_tokens,
+            'top_brands': dict(top_brands)
+        }
+
+token_usage = TokenUsageTracker(int(os.getenv('TOKEN_USAGE_MAX_BRANDS', '1000')))
+
+class WriteBehindBuffer:
+    """
+    Buffer finished analyses and write them to competitor_summary in bulk upserts.
+    Pending rows are appended to a per-process spill file so they survive a crash
+    """
+    def __init__(self, spill_dir: str, max_batch: int, flush_interval: float):
+        self.spill_dir = spill_dir
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.spill_path: Optional[str] = None
+        self.pending: Dict[str, Dict] = {}
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.rows_flushed = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._spill_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # Resolved here rather than at import so each forked worker gets its own file
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.spill_path = os.path.join(self.spill_dir, f"write_behind-{os.getpid()}.jsonl")
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._spill_lock = asyncio.Lock()
+
+        recovered = await asyncio.to_thread(self._recover_spill_files)
+        if recovered:
+            logger.info(f"Recovered {recovered} unflushed analyses from spill files")
+            self._wakeup.set()
+        self._task = asyncio.ensure_future(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if not self.pending and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+
+    async def enqueue(self, row: Dict):
+        # Appends and rewrites are serialized so a row cannot land in a file being replaced
+        async with self._spill_lock:
+            self.pending[row['brand_name']] = row
+            await asyncio.to_thread(self._append_spill, row)
+        if len(self.pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self.pending:
+                batch = dict(list(self.pending.items())[:self.max_batch])
+                start = time.monotonic()
+                try:
+                    async with stage_limits['update'].slot():
+                        await supabase.table('competitor_summary').upsert(
+                            list(batch.values()), on_conflict='brand_name'
+                        ).execute()
+                except Exception as e:
+                    self.failed_flushes += 1
+                    logger.error(f"Write-behind flush of {len(batch)} rows failed: {str(e)}")
+                    return
+
+                elapsed = time.monotonic() - start
+                for brand_name, row in batch.items():
+                    # Keep rows that were replaced while the upsert was running
+                    if self.pending.get(brand_name) is row:
+                        del self.pending[brand_name]
+                    if summary_cache is not None:
+                        summary_cache.invalidate(brand_name)
+                self.flushes += 1
+                self.rows_flushed += len(batch)
+                self.last_batch_size = len(batch)
+                self.max_batch_size = max(self.max_batch_size, len(batch))
+                self.last_flush_seconds = elapsed
+                self.total_flush_seconds += elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+                async with self._spill_lock:
+                    await asyncio.to_thread(self._rewrite_spill, list(self.pending.values()))
+                logger.info(f"Flushed {len(batch)} analyses in {elapsed:.3f}s")
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush loop error: {str(e)}")
+
+    def _append_spill(self, row: Dict):
+        with open(self.spill_path, 'a') as f:
+            f.write(json.dumps(row) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite_spill(self, rows: List[Dict]):
+        tmp_path = self.spill_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.spill_path)
+
+    def _recover_spill_files(self) -> int:
+        """
+        Take over spill files left by processes that are no longer running
+        """
+        recovered = 0
+        for path in glob.glob(os.path.join(self.spill_dir, 'write_behind-*.jsonl')):
+            pid = os.path.basename(path)[len('write_behind-'):-len('.jsonl')]
+            if not pid.isdigit():
+                continue
+            if int(pid) != os.getpid():
+                try:
+                    os.kill(int(pid), 0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue
+
+            # Rename first so two workers starting together cannot both claim it
+            claimed_path = f"{path}.claimed-{os.getpid()}"
+            try:
+                os.rename(path, claimed_path)
+            except FileNotFoundError:
+                continue
+            with open(claimed_path) as f:
+                for line in f:
+                    if line.strip():
+                        row = json.loads(line)
+                        self.pending[row['brand_name']] = row
+                        recovered += 1
+            self._rewrite_spill(list(self.pending.values()))
+            os.remove(claimed_path)
+        return recovered
+
+    def stats(self) -> Dict:
+        return {
+            'pending': len(self.pending),
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'rows_flushed': self.rows_flushed,
+            'last_batch_size': self.last_batch_size,
+            'avg_batch_size': round(self.rows_flushed / self.flushes, 2) if self.flushes else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'last_flush_seconds': round(self.last_flush_seconds, 4),
+            'avg_flush_seconds': round(self.total_flush_seconds / self.flushes, 4) if self.flushes else 0.0,
+            'max_flush_seconds': round(self.max_flush_seconds, 4)
+        }
+
+# Opt-in write-behind for detailed_opportunities; off means every request writes synchronously
+write_behind: Optional[WriteBehindBuffer] = None
+if os.getenv('WRITE_BEHIND_ENABLED', 'false').lower() == 'true':
+    write_behind = WriteBehindBuffer(
+        os.getenv('WRITE_BEHIND_SPILL_DIR', 'write_behind'),
+        int(os.getenv('WRITE_BEHIND_MAX_BATCH', '50')),
+        float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', '2'))
+    )
+
+ANALYSIS_MODEL = "gpt-4o-2024-11-20"
+
+Tier = Literal['fast', 'standard', 'deep']
+
+class ModelRouter:
+    """
+    Pick the model for an analysis from the caller's tier, the input size and the
+    latency and rate-limit headroom recently seen for each model
+    """
+    # Reasons that swap in the fast model only while the tier's own model is degraded
+    fallback_reasons = ('slow_upstream', 'rate_limited')
+
+    def __init__(self, tier_models: Dict[str, str], small_input_tokens: int, latency_limit: float):
+        self.tier_models = tier_models
+        self.small_input_tokens = small_input_tokens
+        self.latency_limit = latency_limit
+        self.latencies: Dict[str, deque] = {}
+        self.decisions: Dict[str, int] = {}
+
+    def record_latency(self, model: str, seconds: float):
+        self.latencies.setdefault(model, deque(maxlen=50)).append(seconds)
+
+    def p95(self, model: str) -> float:
+        return percentile(self.latencies.get(model, ()), 0.95)
+
+    def choose(self, tier: str, input_tokens: int) -> Tuple[str, bool]:
+        """
+        Return the model and whether it is a fallback for a degraded upstream
+        """
+        model = self.tier_models[tier]
+        fast_model = self.tier_models['fast']
+        reason = tier
+
+        # Deep runs always keep the flagship model; other tiers fall back to the fast model
+        if tier == 'standard' and input_tokens <= self.small_input_tokens:
+            model, reason = fast_model, 'small_input'
+        elif tier != 'deep' and model != fast_model:
+            if len(self.latencies.get(model, ())) >= 10 and self.p95(model) > self.latency_limit:
+                model, reason = fast_model, 'slow_upstream'
+            elif openai_headroom.delay_for(model, input_tokens) > 0:
+                model, reason = fast_model, 'rate_limited'
+
+        decision = f"{model}:{reason}"
+        self.decisions[decision] = self.decisions.get(decision, 0) + 1
+        return model, reason in self.fallback_reasons
+
+    def stats(self) -> Dict:
+        return {
+            'tiers': self.tier_models,
+            'decisions': self.decisions,
+            'p95_latency_seconds': {model: round(self.p95(model), 4) for model in self.latencies}
+        }
+
+model_router = ModelRouter(
+    {
+        'fast': os.getenv('OPENAI_FAST_MODEL', 'gpt-4o-mini'),
+        'standard': os.getenv('OPENAI_STANDARD_MODEL', ANALYSIS_MODEL),
+        'deep': os.getenv('OPENAI_DEEP_MODEL', ANALYSIS_MODEL)
+    },
+    int(os.getenv('ROUTER_SMALL_INPUT_TOKENS', '1500')),
+    float(os.getenv('ROUTER_LATENCY_LIMIT_SECONDS', '45'))
+)
+
+class CompletionHedger:
+    """
+    Launch a second identical completion when the first is slower than the hedge delay
+    (fixed, or the model's recent p90 latency) and keep whichever finishes first. Each
+    call earns a fraction of a hedge, which caps hedges as a share of calls
+    """
+    def __init__(self, enabled: bool, delay: float, quantile: float, min_samples: int,
+                 max_ratio: float, capacity: float):
+        self.enabled = enabled
+        self.delay = delay
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.capacity = capacity
+        self.balance = capacity
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+        self.extra_tokens = 0
+
+    def delay_for(self, model: str) -> Optional[float]:
+        if self.delay > 0:
+            return self.delay
+        samples = model_router.latencies.get(model, ())
+        if len(samples) < self.min_samples:
+            return None
+        return percentile(samples, self.quantile)
+
+    async def run(self, model: str, estimated_tokens: int, attempt):
+        """
+        Await attempt(sent), hedging it once if it is still running the hedge delay after
+        it set sent, i.e. after the request actually went upstream
+        """
+        self.calls += 1
+        self.balance = min(self.capacity, self.balance + self.max_ratio)
+        delay = self.delay_for(model) if self.enabled else None
+        if delay is None:
+            return await attempt(None)
+
+        sent = asyncio.Event()
+        tasks = [asyncio.ensure_future(attempt(sent))]
+        sent_wait = asyncio.ensure_future(sent.wait())
+        try:
+            # The delay is upstream latency, so local rate-limit and concurrency waits do not count
+            await asyncio.wait([tasks[0], sent_wait], return_when=asyncio.FIRST_COMPLETED)
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return tasks[0].result()
+            if self.balance < 1:
+                self.skipped += 1
+                return await tasks[0]
+
+            self.balance -= 1
+            self.hedges += 1
+            self.extra_tokens += estimated_tokens
+            logger.info(f"Hedging {model} completion still running after {delay:.2f}s")
+            tasks.append(asyncio.ensure_future(attempt(None)))
+
+            # First success wins; if one attempt fails, keep waiting on the other
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is tasks[1]:
+                            self.hedge_wins += 1
+                        return task.result()
+            return tasks[0].result()
+        finally:
+            sent_wait.cancel()
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    def stats(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'calls': self.calls,
+            'hedges': self.hedges,
+            'hedge_rate': round(self.hedges / self.calls, 4) if self.calls else 0.0,
+            'hedge_wins': self.hedge_wins,
+            'win_rate': round(self.hedge_wins / self.hedges, 4) if self.hedges else 0.0,
+            'skipped_over_budget': self.skipped,
+            # Prompt plus expected completion tokens of the extra calls; the losing call is
+            # billed only up to the point it was cancelled
+            'estimated_extra_tokens': self.extra_tokens
+        }
+
+# Off by default; HEDGE_DELAY_SECONDS=0 hedges at the model's observed HEDGE_QUANTILE latency
+completion_hedger = CompletionHedger(
+    os.getenv('HEDGE_ENABLED', 'false').lower() == 'true',
+    float(os.getenv('HEDGE_DELAY_SECONDS', '0')),
+    float(os.getenv('HEDGE_QUANTILE', '0.9')),
+    int(os.getenv('HEDGE_MIN_SAMPLES', '20')),
+    float(os.getenv('HEDGE_MAX_RATIO', '0.05')),
+    float(os.getenv('HEDGE_BURST', '5'))
 )
 
 class DetailedOpportunities(BaseModel):
     detailed_opportunities: str
 
+class ChunkOpportunities(BaseModel):
+    opportunities: str
+
+class CommonOpportunities(BaseModel):
+    common_opportunities: str
+
+class UniqueOpportunities(BaseModel):
+    unique_opportunities: str
+
 class OpportunitiesResponse(BaseModel):
     brand_name: str
     detailed_opportunities: str
 
-def get_summary_data(brand_name: str) -> Dict:
+class BatchOpportunitiesRequest(BaseModel):
+    brand_names: List[str]
+    concurrency: Optional[int] = None
+    force: bool = False
+    stream: bool = False
+    tier: Tier = 'standard'
+    sectioned: bool = False
+
+class BatchOpportunitiesResult(BaseModel):
+    brand_name: str
+    status_code: int
+    detailed_opportunities: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchOpportunitiesResponse(BaseModel):
+    results: List[BatchOpportunitiesResult]
+
+class JobResponse(BaseModel):
+    job_id: str
+    brand_name: str
+    state: str
+    force: bool = False
+    attempts: int = 0
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    queued_seconds: Optional[float] = None
+    run_seconds: Optional[float] = None
+    result: Optional[OpportunitiesResponse] = None
+    error: Optional[str] = None
+
+class StoredOpportunitiesResponse(BaseModel):
+    brand_name: str
+    detailed_opportunities: str
+    updated_at: Optional[float] = None
+    stale: bool = False
+
+async def get_summary_data(brand_name: str, use_cache: bool = True) -> Dict:
     """
-    Get the existing summary data for the brand
+    Get the existing summary data for the brand, from the summary cache when it has a
+    recent copy
     """
-    response = supabase.table('competitor_summary').select(
-        'competitive_summary, gaps_opportunities'
-    ).eq('brand_name', brand_name).execute()
+    if summary_cache is not None and use_cache:
+        cached = summary_cache.get(brand_name)
+        if cached is not None:
+            return with_pending_write(brand_name, cached)
+    generation = summary_cache.generation if summary_cache is not None else 0
+
+    async with stage_limits['fetch'].slot():
+        response = await supabase.table('competitor_summary').select(
+            'competitive_summary, gaps_opportunities, detailed_opportunities, inputs_fingerprint, '
+            'detailed_opportunities_updated_at'
+        ).eq('brand_name', brand_name).execute()
     
     if not response.data:
         raise ValueError(f"No summary data found for {brand_name}")
     
-    return response.data[0]
+    if summary_cache is not None:
+        summary_cache.set(brand_name, response.data[0], generation)
+    return with_pending_write(brand_name, response.data[0])
+
+async def get_summary_data_bulk(brand_names: List[str], use_cache: bool = True) -> Dict[str, Dict]:
+    """
+    Get the existing summary data for many brands, one query per chunk of names not
+    already in the summary cache
+    """
+    chunk_size = int(os.getenv('SUMMARY_CHUNK_SIZE', '100'))
+    summaries = {}
+    unique_names = []
+    for brand_name in dict.fromkeys(brand_names):
+        cached = summary_cache.get(brand_name) if summary_cache is not None and use_cache else None
+        if cached is not None:
+            summaries[brand_name] = with_pending_write(brand_name, cached)
+        else:
+            unique_names.append(brand_name)
+    generation = summary_cache.generation if summary_cache is not None else 0
+
+    async def fetch_chunk(chunk: List[str]) -> List[Dict]:
+        async with stage_limits['fetch'].slot():
+            response = await supabase.table('competitor_summary').select(
+                'brand_name, competitive_summary, gaps_opportunities, detailed_opportunities, inputs_fingerprint, '
+                'detailed_opportunities_updated_at'
+            ).in_('brand_name', chunk).execute()
+        return response.data
+
+    chunks = [unique_names[i:i + chunk_size] for i in range(0, len(unique_names), chunk_size)]
+    for rows in await asyncio.gather(*[with_retries('fetch', lambda chunk=chunk: fetch_chunk(chunk)) for chunk in chunks]):
+        for row in rows:
+            if row['brand_name'] not in summaries:
+                summaries[row['brand_name']] = with_pending_write(row['brand_name'], row)
+                if summary_cache is not None:
+                    summary_cache.set(row['brand_name'], row, generation)
+    return summaries
+
+def with_pending_write(brand_name: str, row: Dict) -> Dict:
+    """
+    Overlay an analysis still waiting in the write-behind buffer on a row read from the
+    table, so a brand's own recent write is visible before it is flushed
+    """
+    pending = write_behind.pending.get(brand_name) if write_behind is not None else None
+    if pending is None:
+        return row
+    return dict(row, **{column: value for column, value in pending.items() if column != 'brand_name'})
+
+def summary_fingerprint(summary_data: Dict, tier: str = 'standard', sectioned: bool = False) -> str:
+    """
+    Fingerprint the summary inputs a detailed analysis is generated from, and the tier and
+    mode it was generated with, so a stored analysis is only reused for the same ones
+    """
+    inputs = [
+        summary_data.get('competitive_summary'),
+        summary_data.get('gaps_opportunities')
+    ]
+    # Left out for the defaults so fingerprints stored before tiers existed stay valid
+    if tier != 'standard':
+        inputs.append(tier)
+    if sectioned:
+        inputs.append('sectioned')
+    payload = json.dumps(inputs)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
-def analyze_opportunities(brand_name: str, summary_data: Dict) -> DetailedOpportunities:
+ANALYSIS_SECTIONS = {
+    'common': 'Common gaps and opportunities',
+    'unique': 'Gaps and opportunities unique to the brand or industry'
+}
+
+def build_analysis_messages(brand_name: str, summary_data: Dict, section: Optional[str] = None) -> List[Dict]:
     """
-    Create detailed analysis of opportunities
+    Build the chat messages for the detailed opportunities analysis, optionally
+    asking for only one of the ANALYSIS_SECTIONS
     """
+    if section is None:
+        sections = f"""1. {ANALYSIS_SECTIONS['common']}
+    2. {ANALYSIS_SECTIONS['unique']}"""
+    else:
+        sections = f"""{ANALYSIS_SECTIONS[section]} (only this section; the other is written separately)"""
+
     prompt = f"""Based on this competitive analysis for {brand_name}:
 
     Market Overview: {summary_data.get('competitive_summary', 'N/A')}
     Initial Opportunities Identified: {summary_data.get('gaps_opportunities', 'N/A')}
 
     Take the existing opportunities identified, conduct additional research if needed and further reinforce the opportunites or existing gaps in the comeptitive loyalty landscape:
-    1. Common gaps and opportunities
-    2. Gaps and opportunities unique to the brand or industry
+    {sections}
 
     Structure the response in bullet form. Ensure you elaborate on the gaps and opportunities and identify which could provide quick wins and which are longer-term strategic"""
 
-    completion = client.beta.chat.completions.parse(
-        model="gpt-4o-2024-11-20",
-        messages=[
+    return [
+        {"role": "system", "content": f"You are an analyst helping {brand_name} find opportunities to differentiate it's future loyalty program."},
+        {"role": "user", "content": prompt}
+    ]
+
+encodings: Dict[str, tiktoken.Encoding] = {}
+encoding_retry_at: Dict[str, float] = {}
+encoding_lock = threading.Lock()
+
+def encoding_name(model: str) -> str:
+    """
+    Encoding used by a model, falling back to the GPT-4o encoding for unknown names
+    """
+    try:
+        return tiktoken.model.encoding_name_for_model(model)
+    except KeyError:
+        return 'o200k_base'
+
+def load_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Load a model's tokenizer. The first load downloads the encoding file with a blocking
+    request, so this must run off the event loop
+    """
+    name = encoding_name(model)
+    if name not in encodings:
+        encodings[name] = tiktoken.get_encoding(name)
+    return encodings[name]
+
+def load_encoding_in_background(model: str):
+    try:
+        load_encoding(model)
+        logger.info(f"Loaded tokenizer for {model}")
+    except Exception as e:
+        logger.error(f"Could not load tokenizer for {model}: {str(e)}")
+
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """
+    Tokenizer for a model if it is loaded, otherwise None. A missing tokenizer is loaded
+    in a background thread at most once a minute, so requests never wait on the download
+    """
+    name = encoding_name(model)
+    encoding = encodings.get(name)
+    if encoding is None:
+        with encoding_lock:
+            if time.monotonic() >= encoding_retry_at.get(name, 0):
+                encoding_retry_at[name] = time.monotonic() + 60
+                threading.Thread(target=load_encoding_in_background, args=(model,), daemon=True).start()
+    return encoding
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Exact token count of a piece of text for the given model, or the rough four
+    characters per token while the tokenizer is not loaded
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages: List[Dict], model: str) -> int:
+    """
+    Prompt tokens for a list of chat messages, including per-message overhead
+    """
+    return sum(count_tokens(message['content'], model) + 4 for message in messages) + 3
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    """
+    Cut text down to max_tokens, preferring to end on a paragraph or line break
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        if len(text) // 4 <= max_tokens:
+            return text
+        truncated = text[:max_tokens * 4]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        truncated = encoding.decode(tokens[:max_tokens])
+
+    # Avoid leaving a bullet half-finished when a break is reasonably close
+    cut = truncated.rfind('\n\n')
+    if cut < len(truncated) // 2:
+        cut = truncated.rfind('\n')
+    if cut >= len(truncated) // 2:
+        truncated = truncated[:cut]
+    return truncated.rstrip() + '\n[truncated]'
+
+def fit_summary_to_budget(brand_name: str, summary_data: Dict, model: str) -> Dict:
+    """
+    Trim competitive_summary and gaps_opportunities so the analysis prompt fits within
+    ANALYSIS_INPUT_TOKEN_BUDGET. Sections smaller than an even share are kept whole and
+    the larger ones split what is left
+    """
+    budget = int(os.getenv('ANALYSIS_INPUT_TOKEN_BUDGET', '30000'))
+    sections = ['competitive_summary', 'gaps_opportunities']
+    texts = {name: str(summary_data.get(name) or '') for name in sections}
+    sizes = {name: count_tokens(text, model) for name, text in texts.items()}
+
+    empty_sections = dict(summary_data, **{name: '' for name in sections})
+    available = max(budget - count_message_tokens(build_analysis_messages(brand_name, empty_sections), model), 0)
+    if sum(sizes.values()) <= available:
+        return summary_data
+
+    fitted = dict(summary_data)
+    remaining = available
+    ordered = sorted(sections, key=lambda name: sizes[name])
+    for index, name in enumerate(ordered):
+        allowance = min(sizes[name], remaining // (len(ordered) - index))
+        remaining -= allowance
+        if allowance < sizes[name]:
+            fitted[name] = truncate_to_tokens(texts[name], allowance, model)
+            logger.warning(f"Truncated {name} for {brand_name} from {sizes[name]} to {allowance} tokens")
+    return fitted
+
+def estimate_tokens(messages: List[Dict], model: str) -> int:
+    """
+    Prompt + expected completion tokens, used for rate limiting
+    """
+    return count_message_tokens(messages, model) + int(os.getenv('OPENAI_COMPLETION_TOKEN_ESTIMATE', '1500'))
+
+async def parse_completion(model: str, messages: List[Dict], response_format):
+    """
+    Call the structured completions API within the analyze stage limit and rate budgets,
+    hedging slow calls when enabled
+    """
+    estimated = estimate_tokens(messages, model)
+
+    async def attempt(sent: Optional[asyncio.Event]):
+        # A hedged attempt takes its own rate budget and concurrency slot
+        await openai_rate_limiter.acquire(estimated)
+        await openai_headroom.wait(model, estimated)
+        try:
+            async with openai_concurrency.slot():
+                if sent is not None:
+                    sent.set()
+                start = time.monotonic()
+                try:
+                    raw = await client.beta.chat.completions.with_raw_response.parse(
+                        model=model,
+                        messages=messages,
+                        response_format=response_format
+                    )
+                except asyncio.CancelledError:
+                    # A hedging loser was at least this slow; leaving it out would bias the p90 low
+                    model_router.record_latency(model, time.monotonic() - start)
+                    raise
+                model_router.record_latency(model, time.monotonic() - start)
+        except Exception as e:
+            openai_rate_limiter.settle(estimated, 0)
+            if getattr(e, 'response', None) is not None:
+                openai_headroom.observe(model, e.response.headers)
+            raise
+
+        openai_headroom.observe(model, raw.headers)
+        completion = raw.parse()
+        openai_rate_limiter.settle(estimated, completion.usage.total_tokens if completion.usage else estimated)
+        return completion
+
+    async with stage_limits['analyze'].slot():
+        return await completion_hedger.run(model, estimated, attempt)
+
+async def stream_completion(model: str, messages: List[Dict]):
+    """
+    Stream completion text deltas within the analyze stage limit and rate budgets
+    """
+    estimated = estimate_tokens(messages, model)
+    actual = 0
+    async with stage_limits['analyze'].slot():
+        await openai_rate_limiter.acquire(estimated)
+        await openai_headroom.wait(model, estimated)
+        try:
+            # Whole-stream durations are not comparable to single completions, so only errors count
+            async with openai_concurrency.slot(record_latency=False):
+                try:
+                    raw = await client.chat.completions.with_raw_response.create(
+                        model=model,
+                        messages=messages,
+                        stream=True,
+                        stream_options={'include_usage': True}
+                    )
+                except Exception as e:
+                    if getattr(e, 'response', None) is not None:
+                        openai_headroom.observe(model, e.response.headers)
+                    raise
+                openai_headroom.observe(model, raw.headers)
+                async for chunk in raw.parse():
+                    if chunk.usage:
+                        actual = chunk.usage.total_tokens
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        finally:
+            openai_rate_limiter.settle(estimated, actual)
+
+async def cached_parse(brand_name: str, model: str, messages: List[Dict], response_format,
+                       use_cache: bool = True, truncated: bool = False):
+    """
+    Structured completion, served from the LLM cache when an identical request was seen
+    """
+    cache_key = None
+    if llm_cache is not None:
+        cache_key = LLMCache.make_key(
+            model, messages[0]['content'], messages[1]['content'], response_format.model_json_schema()
+        )
+        cached = await llm_cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            logger.info(f"Using cached {response_format.__name__} for {brand_name}")
+            return response_format.model_validate_json(cached)
+
+    completion = await parse_completion(model, messages, response_format)
+    token_usage.record(
+        brand_name,
+        completion.usage.prompt_tokens if completion.usage else count_message_tokens(messages, model),
+        truncated,
+        completion.usage.completion_tokens if completion.usage else 0
+    )
+    parsed = completion.choices[0].message.parsed
+    if cache_key is not None:
+        await llm_cache.set(cache_key, parsed.model_dump_json())
+    return parsed
+
+def split_into_chunks(text: str, chunk_tokens: int, model: str) -> List[str]:
+    """
+    Split text into pieces of at most chunk_tokens, breaking between paragraphs
+    """
+    chunks, current, current_tokens = [], [], 0
+    for paragraph in text.split('\n\n'):
+        size = count_tokens(paragraph, model)
+        if current and current_tokens + size > chunk_tokens:
+            chunks.append('\n\n'.join(current))
+            current, current_tokens = [], 0
+        if size > chunk_tokens:
+            # A single oversized paragraph is cut on token boundaries
+            encoding = get_encoding(model)
+            if encoding is None:
+                step = chunk_tokens * 4
+                chunks.extend(paragraph[i:i + step] for i in range(0, len(paragraph), step))
+            else:
+                tokens = encoding.encode(paragraph, disallowed_special=())
+                chunks.extend(encoding.decode(tokens[i:i + chunk_tokens]) for i in range(0, len(tokens), chunk_tokens))
+            continue
+        current.append(paragraph)
+        current_tokens += size
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
+
+async def condense_competitive_summary(brand_name: str, summary_data: Dict, model: str, use_cache: bool = True) -> Dict:
+    """
+    Map step for oversized summaries: extract the opportunities from each chunk of the
+    competitive summary concurrently and use the merged extracts as the market overview
+    """
+    chunks = split_into_chunks(
+        str(summary_data['competitive_summary']),
+        int(os.getenv('MAP_REDUCE_CHUNK_TOKENS', '4000')),
+        model
+    )
+    logger.info(f"Competitive summary for {brand_name} is oversized, analyzing {len(chunks)} chunks")
+
+    async def extract(index: int, chunk: str) -> str:
+        messages = [
             {"role": "system", "content": f"You are an analyst helping {brand_name} find opportunities to differentiate it's future loyalty program."},
-            {"role": "user", "content": prompt}
-        ],
-        response_format=DetailedOpportunities
+            {"role": "user", "content": f"""This is part {index + 1} of {len(chunks)} of a competitive analysis for {brand_name}:
+
+    {chunk}
+
+    Extract every gap and opportunity in the competitive loyalty landscape that this part supports, keeping the specific competitors, programs and evidence. Structure the response in bullet form."""}
+        ]
+        result = await cached_parse(brand_name, model, messages, ChunkOpportunities, use_cache)
+        return result.opportunities
+
+    extracts = await asyncio.gather(*[extract(index, chunk) for index, chunk in enumerate(chunks)])
+    condensed = '\n\n'.join(f"Part {index + 1}:\n{extract}" for index, extract in enumerate(extracts))
+    return dict(summary_data, competitive_summary=condensed)
+
+async def prepare_analysis_inputs(brand_name: str, summary_data: Dict, model: str, use_cache: bool = True):
+    """
+    Condense oversized summaries and apply the input budget. Returns the summary data
+    to build the prompt from and whether it had to be truncated
+    """
+    threshold = int(os.getenv('MAP_REDUCE_THRESHOLD_TOKENS', '12000'))
+    if threshold > 0 and count_tokens(str(summary_data.get('competitive_summary') or ''), model) > threshold:
+        summary_data = await condense_competitive_summary(brand_name, summary_data, model, use_cache)
+
+    fitted_summary = fit_summary_to_budget(brand_name, summary_data, model)
+    return fitted_summary, fitted_summary is not summary_data
+
+def route_analysis_model(summary_data: Dict, tier: str) -> Tuple[str, bool]:
+    """
+    Choose the analysis model for a summary's input size and the caller's tier, and
+    whether it is a fallback for a degraded upstream
+    """
+    input_tokens = sum(
+        count_tokens(str(summary_data.get(name) or ''), ANALYSIS_MODEL)
+        for name in ('competitive_summary', 'gaps_opportunities')
     )
-    
-    return completion.choices[0].message.parsed
+    return model_router.choose(tier, input_tokens)
+
+async def analyze_opportunities(brand_name: str, summary_data: Dict, use_cache: bool = True,
+                                tier: str = 'standard', sectioned: bool = False,
+                                model: Optional[str] = None) -> DetailedOpportunities:
+    """
+    Create detailed analysis of opportunities with the given model, or the one routed for the tier.
+    With sectioned set, the common and unique sections are generated concurrently.
+    use_cache=False skips the cache lookup but still stores the fresh completion
+    """
+    if model is None:
+        model, _ = route_analysis_model(summary_data, tier)
+    fitted_summary, truncated = await prepare_analysis_inputs(brand_name, summary_data, model, use_cache)
+    if not sectioned:
+        messages = build_analysis_messages(brand_name, fitted_summary)
+        return await cached_parse(brand_name, model, messages, DetailedOpportunities, use_cache, truncated)
+
+    common, unique = await asyncio.gather(
+        cached_parse(brand_name, model, build_analysis_messages(brand_name, fitted_summary, 'common'),
+                     CommonOpportunities, use_cache, truncated),
+        cached_parse(brand_name, model, build_analysis_messages(brand_name, fitted_summary, 'unique'),
+                     UniqueOpportunities, use_cache, truncated)
+    )
+    return DetailedOpportunities(detailed_opportunities=(
+        f"1. {ANALYSIS_SECTIONS['common']}\n{common.common_opportunities.strip()}\n\n"
+        f"2. {ANALYSIS_SECTIONS['unique']}\n{unique.unique_opportunities.strip()}"
+    ))
+
+def sse_event(data: Dict, event: Optional[str] = None) -> str:
+    """
+    Format one Server-Sent Events message
+    """
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
 
-def update_opportunities_analysis(brand_name: str, analysis: DetailedOpportunities):
+async def stream_opportunities(brand_name: str, summary_data: Dict, fingerprint: str, use_cache: bool = True, tier: str = 'standard'):
     """
-    Update the summary table with detailed opportunities
+    Stream the analysis tokens as SSE messages, then save the full text
     """
+    chunks = []
     try:
-        response = supabase.table('competitor_summary').update({
-            'detailed_opportunities': analysis.detailed_opportunities
-        }).eq('brand_name', brand_name).execute()
+        model, fallback = route_analysis_model(summary_data, tier)
+        fitted_summary, truncated = await prepare_analysis_inputs(brand_name, summary_data, model, use_cache)
+        messages = build_analysis_messages(brand_name, fitted_summary)
+        token_usage.record(brand_name, count_message_tokens(messages, model), truncated)
+        async for delta in stream_completion(model, messages):
+            chunks.append(delta)
+            yield sse_event({'delta': delta})
+
+        analysis = DetailedOpportunities(detailed_opportunities=''.join(chunks))
+        # A fallback analysis is saved without a fingerprint so the next request regenerates it
+        await with_retries('update', lambda: update_opportunities_analysis(
+            brand_name, analysis, None if fallback else fingerprint, model
+        ))
+        yield sse_event({'brand_name': brand_name, 'cached': False}, event='done')
+    except Exception as e:
+        logger.error(f"Error streaming analysis for {brand_name}: {str(e)}")
+        yield sse_event({'detail': str(e)}, event='error')
+
+async def update_opportunities_analysis(brand_name: str, analysis: DetailedOpportunities, fingerprint: Optional[str] = None,
+                                       model: Optional[str] = None):
+    """
+    Update the summary table with detailed opportunities, the fingerprint of their inputs,
+    the model that generated them and when (epoch seconds)
+    """
+    updated_at = time.time()
+    # Write-behind rows drop out of the summary cache when they are flushed
+    if write_behind is not None:
+        row = {
+            'brand_name': brand_name,
+            'detailed_opportunities': analysis.detailed_opportunities,
+            'inputs_fingerprint': fingerprint,
+            'detailed_opportunities_model': model,
+            'detailed_opportunities_updated_at': updated_at
+        }
+        await write_behind.enqueue(row)
+        logger.info(f"Queued detailed opportunities for {brand_name} for write-behind")
+        return row
+
+    try:
+        async with stage_limits['update'].slot():
+            response = await supabase.table('competitor_summary').update({
+                'detailed_opportunities': analysis.detailed_opportunities,
+                'inputs_fingerprint': fingerprint,
+                'detailed_opportunities_model': model,
+                'detailed_opportunities_updated_at': updated_at
+            }).eq('brand_name', brand_name).execute()
+        if summary_cache is not None:
+            summary_cache.invalidate(brand_name)
         
         logger.info(f"Successfully updated detailed opportunities for {brand_name}")
         return response.data[0]
@@ -101,39 +1763,790 @@ def update_opportunities_analysis(brand_name: str, analysis: DetailedOpportuniti
         logger.error(f"Error updating analysis: {str(e)}")
         raise
 
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key onto one in-flight task
+    """
+    def __init__(self):
+        self._flights: Dict[str, Dict] = {}
+        self.started = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def run(self, key: str, coro_factory, cancel_if_abandoned: bool = False,
+                  deadline: Optional[RequestDeadline] = None):
+        """
+        Await the in-flight task for the key, starting it with coro_factory(shared_deadline)
+        if there is none. The task's SharedDeadline follows the callers waiting on it
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight_deadline = SharedDeadline()
+            task = asyncio.ensure_future(coro_factory(flight_deadline))
+            flight = {'task': task, 'waiters': 0, 'deadline': flight_deadline}
+            self._flights[key] = flight
+            task.add_done_callback(lambda t: self._forget(key, t))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"Joining in-flight analysis for {key}")
+
+        # Shield so one caller going away does not cancel the work for the others
+        flight['waiters'] += 1
+        flight['deadline'].join(deadline)
+        try:
+            return await asyncio.shield(flight['task'])
+        except asyncio.CancelledError:
+            # The last caller left; stop the work unless it should finish and be saved anyway
+            if cancel_if_abandoned and flight['waiters'] == 1 and not flight['task'].done():
+                logger.info(f"Cancelling abandoned analysis for {key}")
+                flight['task'].cancel()
+                self.abandoned += 1
+            raise
+        finally:
+            flight['waiters'] -= 1
+            flight['deadline'].leave(deadline)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        flight = self._flights.get(key)
+        if flight is not None and flight['task'] is task:
+            del self._flights[key]
+        # Mark the exception as retrieved in case every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict:
+        return {
+            'in_flight': len(self._flights),
+            'started': self.started,
+            'coalesced': self.coalesced,
+            'abandoned': self.abandoned
+        }
+
+analysis_flights = SingleFlight()
+
+def has_current_analysis(summary_data: Dict, fingerprint: str) -> bool:
+    """
+    Whether the stored analysis was built from the inputs with this fingerprint
+    """
+    return bool(summary_data.get('detailed_opportunities')) and summary_data.get('inputs_fingerprint') == fingerprint
+
+async def run_opportunities_pipeline(brand_name: str, force: bool = False, summary_data: Optional[Dict] = None,
+                                     tier: str = 'standard', sectioned: bool = False) -> DetailedOpportunities:
+    """
+    Fetch the summary (unless prefetched), analyze it and save the detailed opportunities
+    """
+    # Get existing summary data
+    if summary_data is None:
+        summary_data = await run_stage('fetch', lambda: get_summary_data(brand_name, use_cache=not force))
+        logger.info("Retrieved existing summary data")
+
+    # Skip regeneration if the stored analysis was built from the same inputs, tier and mode
+    fingerprint = summary_fingerprint(summary_data, tier, sectioned)
+    if not force and has_current_analysis(summary_data, fingerprint):
+        logger.info(f"Summary unchanged for {brand_name}, returning stored analysis")
+        return DetailedOpportunities(detailed_opportunities=summary_data['detailed_opportunities'])
+
+    # Create detailed analysis
+    model, fallback = route_analysis_model(summary_data, tier)
+    detailed_analysis = await run_stage(
+        'analyze', lambda: analyze_opportunities(brand_name, summary_data, use_cache=not force, tier=tier,
+                                                 sectioned=sectioned, model=model)
+    )
+    logger.info("Created detailed opportunities analysis")
+
+    # Save the analysis; a failed write is retried on its own without a new completion.
+    # A fallback analysis is saved without a fingerprint so the next request regenerates it
+    if fallback:
+        fingerprint = None
+    await run_stage('update', lambda: update_opportunities_analysis(brand_name, detailed_analysis, fingerprint, model))
+
+    return detailed_analysis
+
+async def run_coalesced_pipeline(brand_name: str, force: bool = False, summary_data: Optional[Dict] = None,
+                                 tier: str = 'standard', sectioned: bool = False,
+                                 cancel_if_abandoned: bool = False) -> DetailedOpportunities:
+    """
+    Run the pipeline, sharing the run with concurrent requests for the same brand and tier.
+    The shared run is bounded by the latest deadline of the callers waiting on it.
+    With cancel_if_abandoned, the run is cancelled once every caller has gone away
+    """
+    # Keyed on the exact name: the summary lookup is an exact match, so names that differ
+    # only in case or spacing are different rows
+    flight_key = f"{brand_name}:{tier}" + (':force' if force else '') + (':sectioned' if sectioned else '')
+
+    # Fail fast rather than start or join an analysis this caller's deadline cannot wait for
+    deadline = request_deadline.get()
+    if deadline is not None:
+        if summary_data is None:
+            summary_data = await run_stage('fetch', lambda: get_summary_data(brand_name, use_cache=not force))
+        if force or not has_current_analysis(summary_data, summary_fingerprint(summary_data, tier, sectioned)):
+            timeout = deadline.stage_timeout('analyze')
+            if timeout < min_analyze_seconds:
+                raise deadline_exceeded('analyze', f"Not enough of the request deadline left to analyze ({max(timeout, 0):.2f}s)")
+
+    async def run_shared(flight_deadline: SharedDeadline):
+        # The task copied the context of whichever caller started it; the run follows the
+        # deadlines of every caller waiting on it instead
+        request_deadline.set(None)
+        shared_deadline.set(flight_deadline)
+        return await run_opportunities_pipeline(brand_name, force, summary_data, tier, sectioned)
+
+    return await analysis_flights.run(flight_key, run_shared, cancel_if_abandoned, deadline)
+
+async def run_batch_item(brand_name: str, force: bool, semaphore: asyncio.Semaphore, summaries: Optional[Dict[str, Dict]],
+                         tier: str = 'standard', sectioned: bool = False) -> BatchOpportunitiesResult:
+    """
+    Run the pipeline for one brand of a batch, capturing errors in the result
+    """
+    async with semaphore:
+        try:
+            summary_data = None
+            if summaries is not None:
+                summary_data = summaries.get(brand_name)
+                if summary_data is None:
+                    raise ValueError(f"No summary data found for {brand_name}")
+            analysis = await within_deadline(run_coalesced_pipeline(
+                brand_name, force, summary_data, tier, sectioned,
+                cancel_if_abandoned=disconnect_policy == 'cancel'
+            ))
+            return BatchOpportunitiesResult(
+                brand_name=brand_name,
+                status_code=200,
+                detailed_opportunities=analysis.detailed_opportunities
+            )
+        except DeadlineExceeded as e:
+            return BatchOpportunitiesResult(brand_name=brand_name, status_code=504, error=str(e))
+        except ValueError as e:
+            return BatchOpportunitiesResult(brand_name=brand_name, status_code=404, error=str(e))
+        except Exception as e:
+            logger.error(f"Error processing {brand_name} in batch: {str(e)}")
+            return BatchOpportunitiesResult(brand_name=brand_name, status_code=500, error=str(e))
+
+# Stored analyses older than this are served but refreshed in the background
+freshness_seconds = float(os.getenv('OPPORTUNITIES_FRESHNESS_SECONDS', '86400'))
+# At most one background refresh per brand and variant in this window, even if it failed
+refresh_interval_seconds = float(os.getenv('OPPORTUNITIES_REFRESH_INTERVAL_SECONDS', '300'))
+stored_reads = {
+    'fresh': 0, 'stale': 0, 'missing': 0, 'refreshes': 0, 'refreshes_throttled': 0,
+    'refreshes_not_needed': 0, 'refresh_errors': 0
+}
+background_refreshes = set()
+refresh_started_at: Dict[str, float] = {}
+
+def stored_analysis_staleness(summary_data: Dict, tier: str = 'standard', sectioned: bool = False):
+    """
+    Whether a stored analysis was built from other inputs (or another tier or mode), and
+    whether it is older than the freshness window
+    """
+    updated_at = summary_data.get('detailed_opportunities_updated_at')
+    inputs_changed = summary_data.get('inputs_fingerprint') != summary_fingerprint(summary_data, tier, sectioned)
+    expired = updated_at is None or time.time() - updated_at > freshness_seconds
+    return inputs_changed, expired
+
+def refresh_in_background(brand_name: str, tier: str = 'standard', sectioned: bool = False):
+    """
+    Regenerate a brand's analysis without anyone waiting on it. The row is read again
+    uncached and rechecked first, since another worker may already have refreshed it
+    """
+    refresh_key = f"{brand_name}:{tier}" + (':sectioned' if sectioned else '')
+    now = time.monotonic()
+    if now - refresh_started_at.get(refresh_key, float('-inf')) < refresh_interval_seconds:
+        stored_reads['refreshes_throttled'] += 1
+        return
+    refresh_started_at[refresh_key] = now
+    if len(refresh_started_at) > 10000:
+        for key, started_at in list(refresh_started_at.items()):
+            if now - started_at >= refresh_interval_seconds:
+                del refresh_started_at[key]
+
+    async def refresh():
+        try:
+            summary_data = await with_retries('fetch', lambda: get_summary_data(brand_name, use_cache=False))
+            inputs_changed, expired = stored_analysis_staleness(summary_data, tier, sectioned)
+            if summary_data.get('detailed_opportunities') and not inputs_changed and not expired:
+                stored_reads['refreshes_not_needed'] += 1
+                logger.info(f"Stored analysis for {brand_name} was already refreshed")
+                return
+            # Unchanged inputs would short-circuit to the stored analysis, so an expired one is forced
+            force = bool(summary_data.get('detailed_opportunities')) and not inputs_changed
+            await run_coalesced_pipeline(brand_name, force, summary_data, tier, sectioned)
+            logger.info(f"Background refresh finished for {brand_name}")
+        except Exception as e:
+            stored_reads['refresh_errors'] += 1
+            logger.error(f"Background refresh failed for {brand_name}: {str(e)}")
+
+    stored_reads['refreshes'] += 1
+    # Keep a reference so the task is not garbage collected before it finishes
+    task = asyncio.ensure_future(refresh())
+    background_refreshes.add(task)
+    task.add_done_callback(background_refreshes.discard)
+
+JOB_COLUMNS = [
+    'job_id', 'brand_name', 'force', 'state', 'attempts', 'max_attempts', 'lease_owner',
+    'lease_expires_at', 'available_at', 'created_at', 'started_at', 'finished_at', 'result', 'error'
+]
+
+LEASE_EXPIRED_ERROR = 'Worker lease expired on the final attempt'
+
+def job_from_row(row: Dict) -> JobResponse:
+    """
+    Convert a stored job row to its API representation
+    """
+    started_at, finished_at = row.get('started_at'), row.get('finished_at')
+    return JobResponse(
+        job_id=row['job_id'],
+        brand_name=row['brand_name'],
+        state=row['state'],
+        force=bool(row['force']),
+        attempts=row['attempts'],
+        created_at=row['created_at'],
+        started_at=started_at,
+        finished_at=finished_at,
+        queued_seconds=round(started_at - row['created_at'], 4) if started_at else None,
+        run_seconds=round(finished_at - started_at, 4) if started_at and finished_at else None,
+        result=OpportunitiesResponse(
+            brand_name=row['brand_name'],
+            detailed_opportunities=row['result']
+        ) if row.get('result') is not None and row['state'] == 'succeeded' else None,
+        error=row.get('error')
+    )
+
+def job_retry_delay(attempts: int) -> float:
+    """
+    Exponential backoff before a failed job becomes claimable again
+    """
+    return min(float(os.getenv('JOB_RETRY_BASE_SECONDS', '5')) * 2 ** (attempts - 1), 300.0)
+
+class SqliteJobQueue:
+    """
+    Durable job queue in a local SQLite table, a stand-in for the Supabase table
+    """
+    def __init__(self, path: str, max_attempts: int, lease_seconds: int):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            with self._init_lock:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS opportunity_jobs ('
+                    'job_id TEXT PRIMARY KEY, brand_name TEXT NOT NULL, force INTEGER NOT NULL, '
+                    'state TEXT NOT NULL, attempts INTEGER NOT NULL, max_attempts INTEGER NOT NULL, '
+                    'lease_owner TEXT, lease_expires_at REAL, available_at REAL NOT NULL, '
+                    'created_at REAL NOT NULL, started_at REAL, finished_at REAL, result TEXT, error TEXT)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS opportunity_jobs_state ON opportunity_jobs (state, available_at)')
+                self._initialized = True
+        return conn
+
+    def _enqueue(self, brand_name: str, force: bool) -> Dict:
+        now = time.time()
+        row = {
+            'job_id': uuid.uuid4().hex, 'brand_name': brand_name, 'force': int(force),
+            'state': 'queued', 'attempts': 0, 'max_attempts': self.max_attempts,
+            'lease_owner': None, 'lease_expires_at': None, 'available_at': now,
+            'created_at': now, 'started_at': None, 'finished_at': None, 'result': None, 'error': None
+        }
+        conn = self._connect()
+        try:
+            conn.execute(
+                f"INSERT INTO opportunity_jobs ({', '.join(JOB_COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in JOB_COLUMNS)})",
+                [row[column] for column in JOB_COLUMNS]
+            )
+        finally:
+            conn.close()
+        return row
+
+    def _get(self, job_id: str) -> Optional[Dict]:
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM opportunity_jobs WHERE job_id = ?', (job_id,)).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+
+    def _claim(self, worker_id: str) -> Optional[Dict]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            # IMMEDIATE takes the write lock up front so two workers cannot claim the same row
+            conn.execute('BEGIN IMMEDIATE')
+            # A lease that expired on the last attempt means the job keeps killing its worker
+            conn.execute(
+                "UPDATE opportunity_jobs SET state = 'dead', error = ?, lease_owner = NULL, "
+                "lease_expires_at = NULL, finished_at = ? "
+                "WHERE state = 'running' AND lease_expires_at < ? AND attempts >= max_attempts",
+                (LEASE_EXPIRED_ERROR, now, now)
+            )
+            row = conn.execute(
+                "SELECT * FROM opportunity_jobs WHERE (state = 'queued' AND available_at <= ?) "
+                "OR (state = 'running' AND lease_expires_at < ?) ORDER BY created_at LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                "UPDATE opportunity_jobs SET state = 'running', attempts = attempts + 1, "
+                "lease_owner = ?, lease_expires_at = ?, started_at = ? WHERE job_id = ?",
+                (worker_id, now + self.lease_seconds, now, row['job_id'])
+            )
+            conn.execute('COMMIT')
+            return self._get(row['job_id'])
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _update_owned(self, job_id: str, worker_id: str, values: Dict) -> bool:
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                f"UPDATE opportunity_jobs SET {', '.join(f'{column} = ?' for column in values)} "
+                "WHERE job_id = ? AND lease_owner = ? AND state = 'running'",
+                list(values.values()) + [job_id, worker_id]
+            )
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def _stats(self) -> Dict:
+        conn = self._connect()
+        try:
+            return {row[0]: row[1] for row in conn.execute(
+                'SELECT state, COUNT(*) FROM opportunity_jobs GROUP BY state'
+            ).fetchall()}
+        finally:
+            conn.close()
+
+    def _prune(self, before: float) -> int:
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "DELETE FROM opportunity_jobs WHERE state IN ('succeeded', 'failed') AND finished_at < ?",
+                (before,)
+            ).rowcount
+        finally:
+            conn.close()
+
+    async def enqueue(self, brand_name: str, force: bool = False) -> JobResponse:
+        return job_from_row(await asyncio.to_thread(self._enqueue, brand_name, force))
+
+    async def get(self, job_id: str) -> Optional[JobResponse]:
+        row = await asyncio.to_thread(self._get, job_id)
+        return job_from_row(row) if row else None
+
+    async def claim(self, worker_id: str) -> Optional[Dict]:
+        return await asyncio.to_thread(self._claim, worker_id)
+
+    async def extend_lease(self, job: Dict, worker_id: str) -> bool:
+        return await asyncio.to_thread(
+            self._update_owned, job['job_id'], worker_id,
+            {'lease_expires_at': time.time() + self.lease_seconds}
+        )
+
+    async def complete(self, job: Dict, worker_id: str, result: str) -> bool:
+        return await asyncio.to_thread(
+            self._update_owned, job['job_id'], worker_id,
+            {'state': 'succeeded', 'result': result, 'error': None,
+             'lease_owner': None, 'lease_expires_at': None, 'finished_at': time.time()}
+        )
+
+    async def fail(self, job: Dict, worker_id: str, error: str, retryable: bool = True) -> bool:
+        return await asyncio.to_thread(
+            self._update_owned, job['job_id'], worker_id, job_failure_values(job, error, retryable)
+        )
+
+    async def stats(self) -> Dict:
+        return await asyncio.to_thread(self._stats)
+
+    async def prune(self, before: float) -> int:
+        return await asyncio.to_thread(self._prune, before)
+
+class SupabaseJobQueue:
+    """
+    Durable job queue in the Supabase opportunity_jobs table (same columns as the
+    SQLite table, times stored as epoch seconds). Claims are conditional updates,
+    so only one worker wins each job
+    """
+    def __init__(self, max_attempts: int, lease_seconds: int):
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+
+    async def enqueue(self, brand_name: str, force: bool = False) -> JobResponse:
+        now = time.time()
+        row = {
+            'job_id': uuid.uuid4().hex, 'brand_name': brand_name, 'force': force,
+            'state': 'queued', 'attempts': 0, 'max_attempts': self.max_attempts,
+            'available_at': now, 'created_at': now
+        }
+        response = await supabase.table('opportunity_jobs').insert(row).execute()
+        return job_from_row(response.data[0])
+
+    async def get(self, job_id: str) -> Optional[JobResponse]:
+        response = await supabase.table('opportunity_jobs').select('*').eq('job_id', job_id).execute()
+        return job_from_row(response.data[0]) if response.data else None
+
+    async def claim(self, worker_id: str) -> Optional[Dict]:
+        now = time.time()
+        queued = await supabase.table('opportunity_jobs').select('*').eq(
+            'state', 'queued'
+        ).lte('available_at', now).order('created_at').limit(5).execute()
+        expired = await supabase.table('opportunity_jobs').select('*').eq(
+            'state', 'running'
+        ).lt('lease_expires_at', now).order('created_at').limit(5).execute()
+
+        for candidate in queued.data + expired.data:
+            if candidate['state'] == 'running' and candidate['attempts'] >= candidate['max_attempts']:
+                # A lease that expired on the last attempt means the job keeps killing its worker
+                await supabase.table('opportunity_jobs').update({
+                    'state': 'dead', 'error': LEASE_EXPIRED_ERROR,
+                    'lease_owner': None, 'lease_expires_at': None, 'finished_at': now
+                }).eq('job_id', candidate['job_id']).eq('state', 'running').eq(
+                    'attempts', candidate['attempts']
+                ).lt('lease_expires_at', now).execute()
+                continue
+
+            # Matching on state and attempts makes the update lose if another worker claimed first
+            query = supabase.table('opportunity_jobs').update({
+                'state': 'running',
+                'attempts': candidate['attempts'] + 1,
+                'lease_owner': worker_id,
+                'lease_expires_at': now + self.lease_seconds,
+                'started_at': now
+            }).eq('job_id', candidate['job_id']).eq(
+                'state', candidate['state']
+            ).eq('attempts', candidate['attempts'])
+            if candidate['state'] == 'running':
+                # ...and lose if the owner extended its lease since the select
+                query = query.lt('lease_expires_at', now)
+            response = await query.execute()
+            if response.data:
+                return response.data[0]
+        return None
+
+    async def _update_owned(self, job: Dict, worker_id: str, values: Dict) -> bool:
+        response = await supabase.table('opportunity_jobs').update(values).eq(
+            'job_id', job['job_id']
+        ).eq('lease_owner', worker_id).eq('state', 'running').execute()
+        return bool(response.data)
+
+    async def extend_lease(self, job: Dict, worker_id: str) -> bool:
+        return await self._update_owned(job, worker_id, {'lease_expires_at': time.time() + self.lease_seconds})
+
+    async def complete(self, job: Dict, worker_id: str, result: str) -> bool:
+        return await self._update_owned(job, worker_id, {
+            'state': 'succeeded', 'result': result, 'error': None,
+            'lease_owner': None, 'lease_expires_at': None, 'finished_at': time.time()
+        })
+
+    async def fail(self, job: Dict, worker_id: str, error: str, retryable: bool = True) -> bool:
+        return await self._update_owned(job, worker_id, job_failure_values(job, error, retryable))
+
+    async def stats(self) -> Dict:
+        counts = {}
+        for state in ('queued', 'running', 'succeeded', 'failed', 'dead'):
+            response = await supabase.table('opportunity_jobs').select(
+                'job_id', count='exact', head=True
+            ).eq('state', state).execute()
+            counts[state] = response.count or 0
+        return counts
+
+    async def prune(self, before: float) -> int:
+        response = await supabase.table('opportunity_jobs').delete().in_(
+            'state', ['succeeded', 'failed']
+        ).lt('finished_at', before).execute()
+        return len(response.data)
+
+def job_failure_values(job: Dict, error: str, retryable: bool) -> Dict:
+    """
+    Requeue a failed job with backoff, or move it to failed/dead once it cannot be retried
+    """
+    now = time.time()
+    values = {'error': error, 'lease_owner': None, 'lease_expires_at': None}
+    if not retryable:
+        values.update({'state': 'failed', 'finished_at': now})
+    elif job['attempts'] >= job['max_attempts']:
+        # Dead-lettered jobs are kept for inspection and never pruned
+        values.update({'state': 'dead', 'finished_at': now})
+    else:
+        values.update({'state': 'queued', 'available_at': now + job_retry_delay(job['attempts'])})
+    return values
+
+# Durable queue drained by worker.py. The SQLite backend only works when the API and
+# workers share a disk, so it is for local runs (JOB_QUEUE_BACKEND=sqlite)
+if os.getenv('JOB_QUEUE_BACKEND', 'supabase') == 'supabase':
+    job_queue = SupabaseJobQueue(
+        int(os.getenv('JOB_MAX_ATTEMPTS', '3')),
+        int(os.getenv('JOB_LEASE_SECONDS', '300'))
+    )
+else:
+    job_queue = SqliteJobQueue(
+        os.getenv('JOB_QUEUE_PATH', 'jobs.sqlite3'),
+        int(os.getenv('JOB_MAX_ATTEMPTS', '3')),
+        int(os.getenv('JOB_LEASE_SECONDS', '300'))
+    )
+
+class ClientDisconnected(Exception):
+    """
+    Raised when the HTTP client went away before its analysis finished
+    """
+
+# cancel: stop abandoned analyses; finish: complete them so the result is saved and cached
+disconnect_policy = os.getenv('DISCONNECT_POLICY', 'cancel')
+client_disconnects = 0
+
+async def run_until_disconnected(request: Request, awaitable):
+    """
+    Await a result while polling for the client disconnecting; on disconnect the
+    wait is cancelled and ClientDisconnected is raised
+    """
+    global client_disconnects
+    task = asyncio.ensure_future(awaitable)
+    poll_interval = float(os.getenv('DISCONNECT_POLL_INTERVAL', '1'))
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                client_disconnects += 1
+                logger.info(f"Client disconnected from {request.url.path}, policy: {disconnect_policy}")
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+            # Nobody awaits the cancelled task now, so retrieve its outcome to keep asyncio quiet
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
 # FastAPI endpoints
 @app.get("/")
 async def root():
     logger.info("Health check endpoint called")
     return {"status": "API is running"}
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Report runtime stats for the pipeline stages, caches, limiters and jobs
+    """
+    try:
+        job_stats = await job_queue.stats()
+    except Exception as e:
+        logger.error(f"Error reading job queue stats: {str(e)}")
+        job_stats = None
+
+    return {
+        'stages': {name: limiter.stats() for name, limiter in stage_limits.items()},
+        'single_flight': analysis_flights.stats(),
+        'client_disconnects': client_disconnects,
+        'stored_reads': {**stored_reads, 'refreshing': len(background_refreshes)},
+        'llm_cache': llm_cache.stats() if llm_cache is not None else None,
+        'summary_cache': summary_cache.stats() if summary_cache is not None else None,
+        'write_behind': write_behind.stats() if write_behind is not None else None,
+        'openai_rate_limit': openai_rate_limiter.stats(),
+        'openai_concurrency': openai_concurrency.stats(),
+        'openai_headroom': openai_headroom.stats(),
+        'retries': retry_budget.stats(),
+        'deadlines_exceeded': deadlines_exceeded,
+        'token_usage': token_usage.stats(),
+        'model_router': model_router.stats(),
+        'hedging': completion_hedger.stats(),
+        'jobs': job_stats
+    }
+
+@app.get("/opportunities/{brand_name}/stream")
+async def stream_opportunities_analysis(brand_name: str, force: bool = False, tier: Tier = 'standard'):
+    """
+    Stream a detailed opportunities analysis over Server-Sent Events and save it
+    when the stream ends. An unchanged summary streams the stored analysis
+    """
+    try:
+        summary_data = await with_retries('fetch', lambda: get_summary_data(brand_name, use_cache=not force))
+    except ValueError as e:
+        logger.error(f"Value error: {str(e)}")
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    fingerprint = summary_fingerprint(summary_data, tier)
+    if not force and has_current_analysis(summary_data, fingerprint):
+        async def stored_analysis():
+            yield sse_event({'delta': summary_data['detailed_opportunities']})
+            yield sse_event({'brand_name': brand_name, 'cached': True}, event='done')
+        events = stored_analysis()
+    else:
+        logger.info(f"Streaming opportunities analysis for brand: {brand_name}")
+        events = stream_opportunities(brand_name, summary_data, fingerprint, use_cache=not force, tier=tier)
+
+    return StreamingResponse(
+        events,
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.get("/opportunities/{brand_name}", response_model=StoredOpportunitiesResponse)
+async def get_stored_opportunities_analysis(brand_name: str, tier: Tier = 'standard', sectioned: bool = False):
+    """
+    Return the stored detailed opportunities analysis immediately. If it is older than
+    the freshness window or its summary inputs changed, a refresh starts in the background
+    """
+    try:
+        summary_data = await with_retries('fetch', lambda: get_summary_data(brand_name))
+    except ValueError as e:
+        logger.error(f"Value error: {str(e)}")
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not summary_data.get('detailed_opportunities'):
+        stored_reads['missing'] += 1
+        refresh_in_background(brand_name, tier, sectioned)
+        raise HTTPException(status_code=404, detail=f"No detailed opportunities stored for {brand_name} yet, generating them")
+
+    inputs_changed, expired = stored_analysis_staleness(summary_data, tier, sectioned)
+    stale = inputs_changed or expired
+    if stale:
+        stored_reads['stale'] += 1
+        refresh_in_background(brand_name, tier, sectioned)
+    else:
+        stored_reads['fresh'] += 1
+
+    return StoredOpportunitiesResponse(
+        brand_name=brand_name,
+        detailed_opportunities=summary_data['detailed_opportunities'],
+        updated_at=summary_data.get('detailed_opportunities_updated_at'),
+        stale=stale
+    )
+
+# Declared before /opportunities/{brand_name} so "batch" is not taken as a brand name
+@app.post("/opportunities/batch", response_model=BatchOpportunitiesResponse)
+async def batch_opportunities_analysis(request: BatchOpportunitiesRequest, http_request: Request):
+    """
+    Create and save detailed opportunities analyses for many brands. With stream set,
+    results are sent as newline-delimited JSON in completion order
+    """
+    if not request.brand_names:
+        raise HTTPException(status_code=422, detail="brand_names must not be empty")
+
+    concurrency = min(
+        request.concurrency or int(os.getenv('BATCH_CONCURRENCY', '8')),
+        int(os.getenv('BATCH_MAX_CONCURRENCY', '32'))
+    )
+    if concurrency < 1:
+        raise HTTPException(status_code=422, detail="concurrency must be at least 1")
+    deadline = parse_request_deadline(http_request.headers.get('X-Request-Deadline'))
+    logger.info(f"Starting batch analysis of {len(request.brand_names)} brands with concurrency {concurrency}")
+
+    # Prefetch every summary in a few chunked queries; fall back to per-brand reads
+    try:
+        summaries = await get_summary_data_bulk(request.brand_names, use_cache=not request.force)
+        logger.info(f"Prefetched summary data for {len(summaries)} brands")
+    except Exception as e:
+        logger.error(f"Bulk summary prefetch failed, fetching per brand: {str(e)}")
+        summaries = None
+
+    # Item tasks copy the context when created, so each inherits the batch deadline
+    semaphore = asyncio.Semaphore(concurrency)
+    deadline_token = request_deadline.set(deadline)
+    try:
+        tasks = [
+            asyncio.ensure_future(run_batch_item(brand_name, request.force, semaphore, summaries, request.tier, request.sectioned))
+            for brand_name in request.brand_names
+        ]
+    finally:
+        request_deadline.reset(deadline_token)
+
+    if request.stream:
+        async def stream_results():
+            try:
+                for next_result in asyncio.as_completed(tasks):
+                    result = await next_result
+                    yield result.model_dump_json() + '\n'
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        return StreamingResponse(stream_results(), media_type='application/x-ndjson')
+
+    try:
+        results = await run_until_disconnected(http_request, asyncio.gather(*tasks))
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        for task in tasks:
+            task.cancel()
+    return BatchOpportunitiesResponse(results=results)
+
 @app.post("/opportunities/{brand_name}", response_model=OpportunitiesResponse)
-async def expand_opportunities_analysis(brand_name: str):
+async def expand_opportunities_analysis(brand_name: str, request: Request, force: bool = False,
+                                        tier: Tier = 'standard', sectioned: bool = False):
     """
-    Create and save detailed opportunities analysis for a brand
+    Create and save detailed opportunities analysis for a brand. Returns the stored
+    analysis when the summary is unchanged, unless force is set
     """
+    deadline_token = request_deadline.set(parse_request_deadline(request.headers.get('X-Request-Deadline')))
     try:
         logger.info(f"Starting opportunities analysis for brand: {brand_name}")
         
-        # Get existing summary data
-        summary_data = get_summary_data(brand_name)
-        logger.info("Retrieved existing summary data")
-        
-        # Create detailed analysis
-        detailed_analysis = analyze_opportunities(brand_name, summary_data)
-        logger.info("Created detailed opportunities analysis")
-        
-        # Save the analysis
-        updated_data = update_opportunities_analysis(brand_name, detailed_analysis)
+        # Concurrent requests for the same brand share one pipeline run
+        detailed_analysis = await run_until_disconnected(request, within_deadline(run_coalesced_pipeline(
+            brand_name, force, tier=tier, sectioned=sectioned,
+            cancel_if_abandoned=disconnect_policy == 'cancel'
+        )))
         
         return OpportunitiesResponse(
             brand_name=brand_name,
             detailed_opportunities=detailed_analysis.detailed_opportunities
         )
         
+    except ClientDisconnected:
+        raise HTTPException(status_code=499, detail="Client disconnected")
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except ValueError as e:
         logger.error(f"Value error: {str(e)}")
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        request_deadline.reset(deadline_token)
+
+@app.post("/jobs/opportunities/{brand_name}", response_model=JobResponse, status_code=202)
+async def submit_opportunities_job(brand_name: str, force: bool = False):
+    """
+    Queue a detailed opportunities analysis for a worker and return its job id immediately
+    """
+    try:
+        job = await job_queue.enqueue(brand_name, force)
+    except Exception as e:
+        logger.error(f"Error queueing job: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    logger.info(f"Queued job {job.job_id} for brand: {brand_name}")
+    return job
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    """
+    Report the state, timings and result of a queued analysis
+    """
+    try:
+        job = await job_queue.get(job_id)
+    except Exception as e:
+        logger.error(f"Error reading job: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job found with id {job_id}")
+    return job
@@ -0,0 +1,11 @@
+-- Columns and constraint main.py expects on competitor_summary.
+-- Run before deploying: get_summary_data selects these columns, and PostgREST rejects unknown ones.
+
+-- Fingerprint of the summary inputs the stored detailed_opportunities were generated from
+ALTER TABLE competitor_summary ADD COLUMN IF NOT EXISTS inputs_fingerprint text;
+
+-- When detailed_opportunities was last written, in epoch seconds
+ALTER TABLE competitor_summary ADD COLUMN IF NOT EXISTS detailed_opportunities_updated_at double precision;
+
+-- Write-behind flushes upsert with on_conflict=brand_name, which needs a unique constraint
+CREATE UNIQUE INDEX IF NOT EXISTS competitor_summary_brand_name_key ON competitor_summary (brand_name);
@@ -0,0 +1,22 @@
+-- Durable job queue drained by worker.py (JOB_QUEUE_BACKEND=supabase, the default).
+-- Times are epoch seconds, matching the SQLite queue used for local runs.
+CREATE TABLE IF NOT EXISTS opportunity_jobs (
+    job_id text PRIMARY KEY,
+    brand_name text NOT NULL,
+    force boolean NOT NULL DEFAULT false,
+    state text NOT NULL CHECK (state IN ('queued', 'running', 'succeeded', 'failed', 'dead')),
+    attempts integer NOT NULL DEFAULT 0,
+    max_attempts integer NOT NULL,
+    lease_owner text,
+    lease_expires_at double precision,
+    available_at double precision NOT NULL,
+    created_at double precision NOT NULL,
+    started_at double precision,
+    finished_at double precision,
+    result text,
+    error text
+);
+
+-- Claims look for queued jobs that are due and running jobs whose lease expired
+CREATE INDEX IF NOT EXISTS opportunity_jobs_queued ON opportunity_jobs (state, available_at);
+CREATE INDEX IF NOT EXISTS opportunity_jobs_leases ON opportunity_jobs (state, lease_expires_at);
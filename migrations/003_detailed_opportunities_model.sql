@@ -0,0 +1,3 @@
+-- Model that generated the stored detailed_opportunities. A fast-model fallback during an
+-- upstream slowdown or rate limit is stored with a null inputs_fingerprint so it is regenerated
+ALTER TABLE competitor_summary ADD COLUMN IF NOT EXISTS detailed_opportunities_model text;
@@ -0,0 +1,96 @@
+"""
+Shared setup for the tests: environment defaults and an in-memory stand-in for the
+Supabase tables the service reads and writes
+"""
+import os
+import asyncio
+
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ.setdefault('SUPABASE_URL', 'http://localhost')
+os.environ.setdefault('SUPABASE_KEY', 'test')
+os.environ.setdefault('LLM_CACHE_PATH', '')
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+        self.count = len(data)
+
+class FakeQuery:
+    def __init__(self, db, table: str):
+        self.db = db
+        self.table = table
+        self.op = 'select'
+        self.payload = None
+        self.filters = []
+
+    def select(self, *columns, **kwargs):
+        self.op = 'select'
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = 'update', payload
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = 'insert', payload
+        return self
+
+    def upsert(self, payload, **kwargs):
+        self.op, self.payload = 'upsert', payload
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] < value)
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] <= value)
+        return self
+
+    def order(self, column):
+        return self
+
+    def limit(self, count):
+        return self
+
+    def in_(self, column, values):
+        values = list(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    async def execute(self):
+        self.db.calls.append((self.table, self.op, self.payload))
+        if self.db.fail:
+            raise ConnectionError('database unavailable')
+        await asyncio.sleep(0)
+        rows = self.db.tables.setdefault(self.table, [])
+        matching = [row for row in rows if all(f(row) for f in self.filters)]
+        if self.op == 'select':
+            return FakeResponse([dict(row) for row in matching])
+        if self.op == 'update':
+            for row in matching:
+                row.update(self.payload)
+            return FakeResponse([dict(row) for row in matching])
+        if self.op == 'insert':
+            rows.append(dict(self.payload))
+            return FakeResponse([dict(self.payload)])
+        for item in self.payload:
+            existing = next((row for row in rows if row['brand_name'] == item['brand_name']), None)
+            if existing is None:
+                rows.append(dict(item))
+            else:
+                existing.update(item)
+        return FakeResponse(list(self.payload))
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables = {'competitor_summary': []}
+        self.calls = []
+        self.fail = False
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
@@ -0,0 +1,35 @@
+import asyncio
+import unittest
+
+from tests import support
+import main
+
+class CoalescingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.runs = []
+        self.original_pipeline = main.run_opportunities_pipeline
+
+        async def pipeline(brand_name, force=False, summary_data=None, tier='standard', sectioned=False):
+            self.runs.append(brand_name)
+            await asyncio.sleep(0.05)
+            return main.DetailedOpportunities(detailed_opportunities=f"analysis of {brand_name}")
+        main.run_opportunities_pipeline = pipeline
+
+    async def asyncTearDown(self):
+        main.run_opportunities_pipeline = self.original_pipeline
+
+    async def test_same_brand_shares_one_run(self):
+        results = await asyncio.gather(*[main.run_coalesced_pipeline('Nike') for _ in range(3)])
+        self.assertEqual(self.runs, ['Nike'])
+        self.assertEqual({result.detailed_opportunities for result in results}, {'analysis of Nike'})
+
+    async def test_names_differing_in_case_are_not_merged(self):
+        upper, lower = await asyncio.gather(
+            main.run_coalesced_pipeline('NIKE'), main.run_coalesced_pipeline('nike')
+        )
+        self.assertEqual(sorted(self.runs), ['NIKE', 'nike'])
+        self.assertEqual(upper.detailed_opportunities, 'analysis of NIKE')
+        self.assertEqual(lower.detailed_opportunities, 'analysis of nike')
+
+if __name__ == '__main__':
+    unittest.main()
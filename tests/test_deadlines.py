@@ -0,0 +1,117 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from fastapi import HTTPException
+
+from tests import support
+import main
+
+class DeadlineTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.runs = []
+        self.stopped = 0
+        self.original_pipeline = main.run_opportunities_pipeline
+        self.original_min_analyze_seconds = main.min_analyze_seconds
+        main.min_analyze_seconds = 0.05
+
+        async def slow_pipeline(brand_name, force=False, summary_data=None, tier='standard', sectioned=False):
+            self.runs.append(main.current_deadline())
+            try:
+                await main.run_stage('analyze', lambda: asyncio.sleep(0.3))
+            except (asyncio.CancelledError, main.DeadlineExceeded):
+                self.stopped += 1
+                raise
+            return main.DetailedOpportunities(detailed_opportunities=f"analysis of {brand_name}")
+        main.run_opportunities_pipeline = slow_pipeline
+
+    async def asyncTearDown(self):
+        main.run_opportunities_pipeline = self.original_pipeline
+        main.min_analyze_seconds = self.original_min_analyze_seconds
+
+    async def call_with_deadline(self, budget_ms, brand_name='A', cancel_if_abandoned=False, summary_data=None):
+        main.request_deadline.set(main.parse_request_deadline(str(budget_ms)) if budget_ms else None)
+        return await main.within_deadline(main.run_coalesced_pipeline(
+            brand_name, summary_data=summary_data or {}, cancel_if_abandoned=cancel_if_abandoned
+        ))
+
+    async def test_shared_run_is_unbounded_once_a_caller_without_deadline_joins(self):
+        # The caller with the short deadline starts the run; the one without a deadline joins it
+        short = asyncio.ensure_future(self.call_with_deadline(100))
+        await asyncio.sleep(0.01)
+        unbounded = asyncio.ensure_future(self.call_with_deadline(None))
+
+        with self.assertRaises(main.DeadlineExceeded):
+            await short
+        analysis = await unbounded
+        self.assertEqual(analysis.detailed_opportunities, 'analysis of A')
+        self.assertEqual(self.stopped, 0)
+
+    async def test_shared_run_follows_latest_waiter_deadline(self):
+        short = asyncio.ensure_future(self.call_with_deadline(100))
+        await asyncio.sleep(0.01)
+        longer = asyncio.ensure_future(self.call_with_deadline(1000))
+
+        with self.assertRaises(main.DeadlineExceeded):
+            await short
+        analysis = await longer
+        self.assertEqual(analysis.detailed_opportunities, 'analysis of A')
+        self.assertEqual(len(self.runs), 1)
+
+    async def test_run_left_to_finish_is_bounded_by_last_deadline(self):
+        with self.assertRaises(main.DeadlineExceeded):
+            await self.call_with_deadline(100)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.stopped, 1)
+
+    async def test_abandoned_run_is_cancelled_when_last_caller_times_out(self):
+        with self.assertRaises(main.DeadlineExceeded):
+            await self.call_with_deadline(100, cancel_if_abandoned=True)
+        await asyncio.sleep(0)
+        self.assertEqual(self.stopped, 1)
+
+    async def test_batch_items_are_bounded_by_their_own_deadline(self):
+        semaphore = asyncio.Semaphore(4)
+        summaries = {'A': {}}
+        main.request_deadline.set(main.parse_request_deadline('100'))
+        short = asyncio.ensure_future(main.run_batch_item('A', False, semaphore, summaries))
+        main.request_deadline.set(None)
+        unbounded = asyncio.ensure_future(main.run_batch_item('A', False, semaphore, summaries))
+
+        results = await asyncio.gather(short, unbounded)
+        self.assertEqual([result.status_code for result in results], [504, 200])
+        self.assertEqual(len(self.runs), 1)
+
+    async def test_analysis_is_not_started_without_enough_budget(self):
+        main.run_opportunities_pipeline = self.original_pipeline
+        main.min_analyze_seconds = self.original_min_analyze_seconds
+        db = support.FakeSupabase()
+        db.tables['competitor_summary'].append({'brand_name': 'A', 'competitive_summary': 'summary'})
+        completions = []
+
+        async def fake_parse(*args):
+            completions.append(args)
+        patches = [
+            mock.patch.object(main, 'supabase', db),
+            mock.patch.object(main, 'summary_cache', None),
+            mock.patch.object(main, 'cached_parse', fake_parse)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        started = main.analysis_flights.started
+        with self.assertRaises(main.DeadlineExceeded):
+            await self.call_with_deadline(1000)
+        self.assertEqual(completions, [])
+        self.assertEqual(main.analysis_flights.started, started)
+
+    def test_invalid_header_is_rejected(self):
+        for value in ('abc', '0', '-5'):
+            with self.assertRaises(HTTPException) as raised:
+                main.parse_request_deadline(value)
+            self.assertEqual(raised.exception.status_code, 400)
+        self.assertIsNone(main.parse_request_deadline(None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from tests import support
+import main
+
+class FakeRaw:
+    headers = {}
+
+    def parse(self):
+        return SimpleNamespace(usage=None)
+
+class HedgingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.durations = []
+        self.sent = 0
+
+        async def fake_parse(**kwargs):
+            self.sent += 1
+            await asyncio.sleep(self.durations.pop(0))
+            return FakeRaw()
+        client = SimpleNamespace(beta=SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+            with_raw_response=SimpleNamespace(parse=fake_parse)
+        ))))
+        self.hedger = main.CompletionHedger(True, 0.2, 0.9, 20, 1.0, 5)
+        patches = [
+            mock.patch.object(main, 'client', client),
+            mock.patch.object(main, 'completion_hedger', self.hedger),
+            mock.patch.object(main, 'openai_concurrency', main.AdaptiveConcurrencyLimiter(1, 1, 1, 60)),
+            mock.patch.object(main.model_router, 'latencies', {})
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def parse(self):
+        return await main.parse_completion('model', [{'role': 'user', 'content': 'hi'}], None)
+
+    async def test_calls_queued_for_a_local_slot_are_not_hedged(self):
+        # With one slot, the third call waits 300ms locally but each is upstream for only 150ms
+        self.durations = [0.15, 0.15, 0.15]
+        await asyncio.gather(self.parse(), self.parse(), self.parse())
+        self.assertEqual(self.hedger.hedges, 0)
+        self.assertEqual(self.sent, 3)
+
+    async def test_cancelled_loser_latency_is_recorded(self):
+        main.openai_concurrency.limit = 2
+        self.durations = [1.0, 0.01]
+        await self.parse()
+        self.assertEqual((self.hedger.hedges, self.hedger.hedge_wins), (1, 1))
+        await asyncio.sleep(0)
+        latencies = sorted(main.model_router.latencies['model'])
+        self.assertEqual(len(latencies), 2)
+        self.assertGreaterEqual(latencies[1], 0.2)
+        self.assertEqual(len(main.openai_concurrency.latencies), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import time
+import tempfile
+import unittest
+
+from tests import support
+import main
+
+class SqliteJobQueueTest(unittest.IsolatedAsyncioTestCase):
+    def make_queue(self, lease_seconds: int) -> main.SqliteJobQueue:
+        return main.SqliteJobQueue(os.path.join(tempfile.mkdtemp(), 'jobs.sqlite3'), 3, lease_seconds)
+
+    def skip_backoff(self, queue: main.SqliteJobQueue, job_id: str):
+        conn = queue._connect()
+        try:
+            conn.execute('UPDATE opportunity_jobs SET available_at = 0 WHERE job_id = ?', (job_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def test_live_lease_is_not_reclaimed(self):
+        queue = self.make_queue(300)
+        job = await queue.enqueue('A')
+        claimed = await queue.claim('worker-1')
+        self.assertEqual((claimed['job_id'], claimed['attempts']), (job.job_id, 1))
+        self.assertIsNone(await queue.claim('worker-2'))
+
+    async def test_expired_lease_is_reclaimed_until_dead(self):
+        # A negative lease expires as soon as it is granted, like a worker that crashed
+        queue = self.make_queue(-1)
+        job = await queue.enqueue('A')
+        for attempt, worker_id in enumerate(['worker-1', 'worker-2', 'worker-3'], start=1):
+            claimed = await queue.claim(worker_id)
+            self.assertEqual((claimed['attempts'], claimed['lease_owner']), (attempt, worker_id))
+
+        self.assertIsNone(await queue.claim('worker-4'))
+        stored = await queue.get(job.job_id)
+        self.assertEqual((stored.state, stored.attempts), ('dead', 3))
+        self.assertEqual(stored.error, main.LEASE_EXPIRED_ERROR)
+
+    async def test_failed_job_is_requeued_then_dead_lettered(self):
+        queue = self.make_queue(300)
+        job = await queue.enqueue('A')
+        for attempt in range(1, 4):
+            claimed = await queue.claim('worker-1')
+            self.assertEqual(claimed['attempts'], attempt)
+            await queue.fail(claimed, 'worker-1', 'upstream error')
+            self.skip_backoff(queue, job.job_id)
+
+        stored = await queue.get(job.job_id)
+        self.assertEqual((stored.state, stored.attempts, stored.error), ('dead', 3, 'upstream error'))
+        self.assertIsNone(await queue.claim('worker-1'))
+
+class SupabaseJobQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        main.supabase = support.FakeSupabase()
+
+    async def test_expired_lease_is_reclaimed_until_dead(self):
+        queue = main.SupabaseJobQueue(3, -1)
+        job = await queue.enqueue('A')
+        for attempt in range(1, 4):
+            claimed = await queue.claim(f"worker-{attempt}")
+            self.assertEqual(claimed['attempts'], attempt)
+
+        self.assertIsNone(await queue.claim('worker-4'))
+        stored = await queue.get(job.job_id)
+        self.assertEqual((stored.state, stored.attempts), ('dead', 3))
+
+    async def test_lease_extended_after_select_is_not_stolen(self):
+        queue = main.SupabaseJobQueue(3, -1)
+        job = await queue.enqueue('A')
+        owned = await queue.claim('worker-1')
+
+        # The owner extends its lease after another worker selected the job as expired
+        db = main.supabase
+        table = db.table
+        def extending_table(name):
+            query = table(name)
+            execute = query.execute
+            async def execute_after_extend():
+                if query.op == 'update' and query.payload.get('lease_owner') == 'worker-2':
+                    for row in db.tables['opportunity_jobs']:
+                        row['lease_expires_at'] = time.time() + 300
+                return await execute()
+            query.execute = execute_after_extend
+            return query
+        db.table = extending_table
+
+        self.assertIsNone(await queue.claim('worker-2'))
+        self.assertTrue(await queue.complete(owned, 'worker-1', 'analysis'))
+        self.assertEqual((await queue.get(job.job_id)).state, 'succeeded')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+from postgrest.exceptions import APIError
+
+from tests import support
+import main
+
+class TransientErrorTest(unittest.TestCase):
+    def test_postgrest_errors(self):
+        transient = ['502', '503', '504', '429', 'PGRST000', 'PGRST003', '08006', '53300', '57014', '40001', '40P01']
+        permanent = ['400', '404', 'PGRST116', 'PGRST204', '42703', '23505', None]
+        for code in transient:
+            self.assertTrue(main.is_transient_error(APIError({'code': code})), code)
+        for code in permanent:
+            self.assertFalse(main.is_transient_error(APIError({'code': code})), code)
+
+    def test_gateway_error_without_json_body(self):
+        # postgrest-py puts the HTTP status in code when the body is not JSON
+        self.assertTrue(main.is_transient_error(APIError({'code': 503, 'message': 'JSON could not be generated'})))
+
+class WithRetriesTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.original_policy = main.retry_policies['fetch']
+        main.retry_policies['fetch'] = main.RetryPolicy(3, 0.0, 0.0)
+
+    def tearDown(self):
+        main.retry_policies['fetch'] = self.original_policy
+
+    async def test_fetch_retries_postgrest_unavailable(self):
+        attempts = []
+
+        async def operation():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise APIError({'code': '503'})
+            return 'row'
+        self.assertEqual(await main.with_retries('fetch', operation), 'row')
+        self.assertEqual(len(attempts), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from unittest import mock
+
+from tests import support
+import main
+
+class FallbackAnalysisTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = support.FakeSupabase()
+        self.db.tables['competitor_summary'].append({
+            'brand_name': 'Acme', 'competitive_summary': 'summary ' * 2000, 'gaps_opportunities': 'gaps'
+        })
+        self.models = []
+        async def fake_parse(brand_name, model, messages, response_format, *args):
+            self.models.append(model)
+            return main.DetailedOpportunities(detailed_opportunities=f"from {model}")
+        patches = [
+            mock.patch.object(main, 'supabase', self.db),
+            mock.patch.object(main, 'summary_cache', None),
+            mock.patch.object(main, 'write_behind', None),
+            mock.patch.object(main, 'cached_parse', fake_parse),
+            mock.patch.object(main.model_router, 'latencies', {})
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def test_fallback_analysis_is_regenerated_once_upstream_recovers(self):
+        standard, fast = main.model_router.tier_models['standard'], main.model_router.tier_models['fast']
+        main.model_router.latencies[standard] = [main.model_router.latency_limit + 1] * 10
+        await main.run_opportunities_pipeline('Acme')
+        row = self.db.tables['competitor_summary'][0]
+        self.assertEqual(row['detailed_opportunities_model'], fast)
+        self.assertIsNone(row['inputs_fingerprint'])
+
+        main.model_router.latencies[standard] = [1.0] * 10
+        result = await main.run_opportunities_pipeline('Acme')
+        self.assertEqual(result.detailed_opportunities, f"from {standard}")
+        self.assertEqual(self.models, [fast, standard])
+        self.assertEqual(row['detailed_opportunities_model'], standard)
+        self.assertEqual(row['inputs_fingerprint'], main.summary_fingerprint(row))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from tests import support
+import main
+
+class WriteBehindTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = support.FakeSupabase()
+        main.supabase = self.db
+        self.spill_dir = tempfile.mkdtemp()
+        self.buffer = main.WriteBehindBuffer(self.spill_dir, 50, 3600)
+
+    async def asyncTearDown(self):
+        self.db.fail = False
+        await self.buffer.stop()
+
+    def spilled(self, path=None):
+        with open(path or self.buffer.spill_path) as f:
+            return [json.loads(line)['brand_name'] for line in f if line.strip()]
+
+    async def test_recovers_spill_file_of_dead_process(self):
+        dead_pid = 2 ** 22 + 1
+        with open(os.path.join(self.spill_dir, f"write_behind-{dead_pid}.jsonl"), 'w') as f:
+            f.write(json.dumps({'brand_name': 'A', 'detailed_opportunities': 'old'}) + '\n')
+            f.write(json.dumps({'brand_name': 'A', 'detailed_opportunities': 'new'}) + '\n')
+
+        await self.buffer.start()
+        self.assertEqual(list(self.buffer.pending), ['A'])
+        self.assertEqual(self.spilled(), ['A'])
+
+        await self.buffer.flush()
+        self.assertEqual(self.db.tables['competitor_summary'], [{'brand_name': 'A', 'detailed_opportunities': 'new'}])
+        self.assertEqual(self.spilled(), [])
+        self.assertEqual(os.listdir(self.spill_dir), [os.path.basename(self.buffer.spill_path)])
+
+    async def test_failed_flush_keeps_rows_spilled(self):
+        await self.buffer.start()
+        self.db.fail = True
+        await self.buffer.enqueue({'brand_name': 'A', 'detailed_opportunities': 'text'})
+        await self.buffer.flush()
+        self.assertEqual(list(self.buffer.pending), ['A'])
+        self.assertEqual(self.spilled(), ['A'])
+
+    async def test_row_queued_during_spill_rewrite_is_not_lost(self):
+        await self.buffer.start()
+        await self.buffer.enqueue({'brand_name': 'A', 'detailed_opportunities': 'text'})
+
+        # Hold the rewrite after a successful upsert and queue another row meanwhile
+        rewriting, release = threading.Event(), threading.Event()
+        rewrite = self.buffer._rewrite_spill
+        def slow_rewrite(rows):
+            rewriting.set()
+            release.wait(5)
+            rewrite(rows)
+        self.buffer._rewrite_spill = slow_rewrite
+
+        flush = asyncio.ensure_future(self.buffer.flush())
+        await asyncio.to_thread(rewriting.wait, 5)
+        enqueue = asyncio.ensure_future(self.buffer.enqueue({'brand_name': 'B', 'detailed_opportunities': 'text'}))
+        await asyncio.sleep(0.05)
+        self.db.fail = True
+        release.set()
+        await asyncio.gather(flush, enqueue)
+
+        # B's upsert failed, so it must still be in the spill file to survive a crash
+        self.assertIn('B', self.buffer.pending)
+        self.assertEqual(self.spilled(), ['B'])
+
+    async def test_reads_see_pending_writes_before_the_flush(self):
+        self.db.tables['competitor_summary'].append({
+            'brand_name': 'A', 'competitive_summary': 'summary', 'gaps_opportunities': 'gaps',
+            'detailed_opportunities': 'old', 'inputs_fingerprint': 'old-fingerprint'
+        })
+        await self.buffer.start()
+        original_buffer, original_cache = main.write_behind, main.summary_cache
+        main.write_behind, main.summary_cache = self.buffer, main.SummaryCache(60, 1024 * 1024)
+        try:
+            self.assertEqual((await main.get_summary_data('A'))['detailed_opportunities'], 'old')
+            await main.update_opportunities_analysis(
+                'A', main.DetailedOpportunities(detailed_opportunities='new'), 'new-fingerprint'
+            )
+
+            for row in (await main.get_summary_data('A'), (await main.get_summary_data_bulk(['A']))['A']):
+                self.assertEqual(row['detailed_opportunities'], 'new')
+                self.assertEqual(row['inputs_fingerprint'], 'new-fingerprint')
+                self.assertIsNotNone(row['detailed_opportunities_updated_at'])
+                self.assertEqual(row['competitive_summary'], 'summary')
+            self.assertEqual(self.db.tables['competitor_summary'][0]['detailed_opportunities'], 'old')
+        finally:
+            main.write_behind, main.summary_cache = original_buffer, original_cache
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import time
+import uuid
+import signal
+import socket
+import asyncio
+import logging
+from typing import Dict
+
+import main
+
+logger = logging.getLogger('worker')
+
+async def keep_lease(job: Dict, worker_id: str):
+    """
+    Extend the job lease while it runs so other workers do not reclaim it
+    """
+    interval = main.job_queue.lease_seconds / 3
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not await main.job_queue.extend_lease(job, worker_id):
+                logger.warning(f"Lost lease on job {job['job_id']}")
+                return
+        except Exception as e:
+            logger.error(f"Error extending lease on job {job['job_id']}: {str(e)}")
+
+async def process_job(job: Dict, worker_id: str):
+    """
+    Run the opportunities pipeline for one claimed job and record the outcome
+    """
+    logger.info(f"Processing job {job['job_id']} for {job['brand_name']} (attempt {job['attempts']})")
+    lease_task = asyncio.ensure_future(keep_lease(job, worker_id))
+    try:
+        analysis = await main.run_coalesced_pipeline(job['brand_name'], bool(job['force']))
+        if await main.job_queue.complete(job, worker_id, analysis.detailed_opportunities):
+            logger.info(f"Completed job {job['job_id']}")
+        else:
+            logger.warning(f"Lost lease on job {job['job_id']} before completing it; the result was not recorded")
+    except ValueError as e:
+        # Missing summary data will not fix itself on retry
+        logger.error(f"Job {job['job_id']} failed: {str(e)}")
+        if not await main.job_queue.fail(job, worker_id, str(e), retryable=False):
+            logger.warning(f"Lost lease on job {job['job_id']} before recording its failure")
+    except Exception as e:
+        logger.error(f"Job {job['job_id']} failed, will retry if attempts remain: {str(e)}")
+        if not await main.job_queue.fail(job, worker_id, str(e)):
+            logger.warning(f"Lost lease on job {job['job_id']} before recording its failure")
+    finally:
+        lease_task.cancel()
+
+async def claim_loop(worker_id: str, stopping: asyncio.Event):
+    """
+    Claim and process jobs one at a time until asked to stop
+    """
+    poll_interval = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+    while not stopping.is_set():
+        try:
+            job = await main.job_queue.claim(worker_id)
+        except Exception as e:
+            logger.error(f"Error claiming job: {str(e)}")
+            job = None
+
+        if job is None:
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        await process_job(job, worker_id)
+
+async def prune_loop(stopping: asyncio.Event):
+    """
+    Periodically delete finished jobs older than the retention window
+    """
+    retention = int(os.getenv('JOB_RETENTION_SECONDS', '86400'))
+    while not stopping.is_set():
+        try:
+            pruned = await main.job_queue.prune(time.time() - retention)
+            if pruned:
+                logger.info(f"Pruned {pruned} finished jobs")
+        except Exception as e:
+            logger.error(f"Error pruning jobs: {str(e)}")
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=600)
+        except asyncio.TimeoutError:
+            pass
+
+async def run_worker():
+    # Dynos do not share a disk, so a worker there would never see jobs queued in SQLite
+    if isinstance(main.job_queue, main.SqliteJobQueue) and os.getenv('DYNO'):
+        logger.error("JOB_QUEUE_BACKEND=sqlite cannot be shared between dynos; use supabase")
+        raise SystemExit(1)
+
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    concurrency = int(os.getenv('WORKER_CONCURRENCY', '4'))
+
+    # Stop claiming on SIGTERM and let in-flight jobs finish; unfinished leases expire and are retried
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    # Reuse the app lifespan for the Supabase client and write-behind buffer
+    async with main.lifespan(main.app):
+        logger.info(f"Worker {worker_id} started with concurrency {concurrency}")
+        await asyncio.gather(
+            prune_loop(stopping),
+            *[claim_loop(worker_id, stopping) for _ in range(concurrency)]
+        )
+        logger.info(f"Worker {worker_id} stopping")
+
+if __name__ == '__main__':
+    asyncio.run(run_worker())